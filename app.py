@@ -2,20 +2,45 @@ import streamlit as st
 import os
 import time
 import random
-from audio_generator import generate_lofi_track
-from utils import fetch_image, create_video, convert_wav_to_mp3
-from constants import MUSIC_TYPES, PROMPTS, STYLE_MODIFIERS
+import logging
+import threading
+from urllib.parse import urlsplit
+from jobs import JobManager, QueueFull, VIDEO_MODES, PREVIEW_SEC, build_preview
+from utils import ImagePrefetcher, IMAGE_SOURCES
+from metrics import PROFILERS
+from serving import ArtifactServer, STATIC_PORT, STATIC_URL
+from constants import MUSIC_TYPES
 
+# Labels for utils.IMAGE_SOURCES in the sidebar
+IMAGE_SOURCE_LABELS = {"auto": "AI image (offline fallback)", "remote": "AI image only", "procedural": "Procedural (offline)"}
+VIDEO_MODE_LABELS = {"still": "Still image", "visualizer": "Audio visualizer"}
 
-# Page configuration
-st.set_page_config(
-    page_title="LoFi Studio",
-    page_icon="🎧",
-    layout="centered"
-)
+# Seconds between status polls while a render job is in flight
+POLL_INTERVAL = 0.5
+STAGE_ICONS = {"pending": "⏸️", "running": "⏳", "done": "✅", "failed": "❌"}
 
-# Custom CSS for aesthetics
-st.markdown("""
+# Without the static server, artifacts up to this size are held in memory,
+# shared by every session, at most INLINE_CACHE_ENTRIES of them; bigger ones
+# are left to Streamlit
+INLINE_MAX_BYTES = 16 * 2**20
+INLINE_CACHE_ENTRIES = 16
+INLINE_CACHE_TTL = 3600
+
+logger = logging.getLogger("lofi.app")
+
+
+def setup_page():
+    # Called from main() rather than at import time, because render workers
+    # import this script as their __main__
+    # Page configuration
+    st.set_page_config(
+        page_title="LoFi Studio",
+        page_icon="🎧",
+        layout="centered"
+    )
+
+    # Custom CSS for aesthetics
+    st.markdown("""
     <style>
     .stApp {
         background-color: #0e1117;
@@ -43,74 +68,160 @@ st.markdown("""
         margin-bottom: 20px;
     }
     </style>
-""", unsafe_allow_html=True)
-
-def generate_content(track_length, music_type):
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    # 1. Generate Audio
-    status_text.text("🎹 Composing melody...")
+    """, unsafe_allow_html=True)
+
+@st.cache_resource
+def get_job_manager():
+    # One shared render queue for every session on this server
+    return JobManager(max_running=2, max_queued=8)
+
+@st.cache_resource
+def get_image_prefetcher():
+    # Keeps every style's backgrounds cached so renders rarely wait on the network
+    return ImagePrefetcher().start()
+
+@st.cache_resource
+def get_artifact_server():
+    # Serves finished artifacts straight from the cache; None if disabled or the port is taken
+    if not STATIC_PORT:
+        return None
     try:
-        # Define paths
-        wav_path = "assets/generated/generated_track.wav"
-        mp3_path = "assets/generated/generated_song.mp3"
-        
-        wav_file = generate_lofi_track(track_length, music_type, output_filename=wav_path)
-        # Convert to MP3
-        mp3_file = convert_wav_to_mp3(wav_file, output_path=mp3_path)
-        st.session_state.audio_path = mp3_file
-    except Exception as e:
-        status_text.text(f"Error generating audio: {e}")
-        st.error(f"Error generating audio: {e}")
-        return
-    progress_bar.progress(30)
-    
-    # 2. Fetch Image
-    status_text.text("🎨 Painting the scene...")
-    
-    # Select random base prompt and add style modifiers
-    base_prompt = random.choice(PROMPTS.get(music_type, ["lofi cozy aesthetic"]))
-    final_prompt = f"{base_prompt}, {random.choice(STYLE_MODIFIERS)}"
-    
+        return ArtifactServer(port=STATIC_PORT).start()
+    except OSError as e:
+        logger.warning("Artifact server unavailable on port %s: %s", STATIC_PORT, e)
+        return None
+
+@st.cache_resource(max_entries=INLINE_CACHE_ENTRIES, ttl=INLINE_CACHE_TTL)
+def artifact_bytes(path):
+    # Cache paths are content hashes, so the bytes for a path never change.
+    # cache_resource hands every session the same object rather than a copy.
+    with open(path, "rb") as f:
+        return f.read()
+
+def artifact_url(path, download=None):
+    # URL of a cached artifact on the static server, or None to go through Streamlit
+    server = get_artifact_server()
+    if server is None:
+        return None
+    base = STATIC_URL
+    if not base:
+        # Same host the browser already reaches the app at; an https page
+        # can't load media over plain http, so that needs LOFI_STATIC_URL
+        app_url = urlsplit(st.context.url or "http://localhost")
+        if app_url.scheme != "http":
+            return None
+        host = app_url.hostname or "localhost"
+        if not server.reachable_from(host):
+            return None
+        base = f"http://[{host}]:{server.port}" if ":" in host else f"http://{host}:{server.port}"
+    return server.url(path, base, download)
+
+def media(path):
+    # What to give st.audio/st.video/st.image for an artifact: a URL the
+    # browser fetches itself, else shared in-memory bytes for small files, else the path
+    url = artifact_url(path)
+    if url:
+        return url
+    if os.path.getsize(path) <= INLINE_MAX_BYTES:
+        return artifact_bytes(path)
+    return path
+
+def download_button(label, path, file_name, mime):
+    # A direct link when the static server is up; otherwise Streamlit reads the
+    # file only once the button is clicked
+    url = artifact_url(path, download=file_name)
+    if url:
+        st.link_button(label, url)
+    else:
+        def read():
+            with open(path, "rb") as f:
+                return f.read()
+        st.download_button(label=label, data=read, file_name=file_name, mime=mime)
+
+@st.cache_resource
+def start_warm_up():
+    # Once per server, after the first page is drawn: render workers, SciPy and
+    # ffmpeg load in the background instead of inside the first render
+    thread = threading.Thread(target=get_job_manager().warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def generate_content(track_length, music_type, seed, image_source="auto", video_mode="still", profiler=None,
+                     progressive=False):
     try:
-        img_path = "assets/generated/background_image.jpg"
-        image_file = fetch_image(final_prompt, output_filename=img_path)
-        st.session_state.image_path = image_file
-    except Exception as e:
-        status_text.text(f"Error fetching image: {e}")
-        st.error(f"Error fetching image: {e}")
+        st.session_state.job_id = get_job_manager().submit(track_length, music_type, seed, image_source, video_mode,
+                                                           profiler, progressive)
+    except QueueFull as e:
+        st.warning(f"The studio is busy: {e}")
         return
-    progress_bar.progress(60)
-    
-    # 3. Render Video
-    status_text.text("🎬 Rendering video final cut...")
-    try:
-        if not st.session_state.get('audio_path'):
-             st.error("Audio generation failed: No audio path in session.")
-             return
-        if not st.session_state.get('image_path'):
-             st.error("Image fetch failed: No image path in session.")
-             return
-        
-        vid_path = "assets/generated/lofi_studio_output.mp4"
-        video_file = create_video(st.session_state.audio_path, st.session_state.image_path, output_path=vid_path)
-        st.session_state.video_path = video_file
-    except Exception as e:
-        status_text.text(f"Error rendering video: {e}")
-        st.error(f"Error rendering video: {e}")
-        import traceback
-        st.code(traceback.format_exc())
+    st.session_state.generated = False
+    st.session_state.partial_audio = None
+
+def preview_content(track_length, music_type, seed, image_source="auto", video_mode="still", profiler=None):
+    # Draft of the opening right away, then the full track for the same seed in
+    # the background, replacing whatever render this session had running
+    with st.spinner("🎧 Sketching a draft..."):
+        st.session_state.preview_path = build_preview(track_length, music_type, seed)
+    st.session_state.preview_seed = seed
+    if st.session_state.job_id:
+        get_job_manager().cancel(st.session_state.job_id)
+    generate_content(track_length, music_type, seed, image_source, video_mode, profiler, progressive=True)
+
+def show_job_progress():
+    # Poll the session's render job; keeps rerunning until it finishes
+    job = get_job_manager().status(st.session_state.job_id)
+    if job is None:
+        st.session_state.job_id = None
         return
-    progress_bar.progress(100)
-    
-    status_text.text("✨ Creation Complete!")
-    st.session_state.generated = True
-    time.sleep(1)
-    status_text.empty()
-    progress_bar.empty()
+
+    if job["status"] in ("queued", "running"):
+        message = job["message"]
+        if job["status"] == "queued" and job.get("position"):
+            message = f"{message} ({job['position']} ahead of you)"
+        st.progress(job["progress"])
+        st.text(message)
+        st.caption("  ·  ".join(f"{STAGE_ICONS[state]} {name}" for name, state in job["stages"].items()))
+        if job.get("playable_s") and st.button(f"▶️ Play the first {int(job['playable_s'])} s so far"):
+            # A snapshot, so the player is not reset by the next poll
+            with open(job["partial_path"], "rb") as f:
+                st.session_state.partial_audio = f.read()
+        if st.session_state.get('partial_audio'):
+            st.audio(st.session_state.partial_audio, format="audio/mpeg")
+        if st.button("Cancel"):
+            get_job_manager().cancel(job["id"])
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
+
+    st.session_state.job_id = None
+    st.session_state.partial_audio = None
+    st.session_state.metrics = job["metrics"]
+    if job["status"] == "done":
+        st.session_state.update(job["result"])
+        st.session_state.generated = True
+        # Draw the results in place of the draft preview above
+        st.rerun()
+    elif job["status"] == "failed":
+        st.error(job["error"])
+        if job.get("traceback"):
+            st.code(job["traceback"])
+
+def show_metrics(snapshot):
+    # Debug panel: where the last render spent its time
+    with st.expander("🔍 Render metrics", expanded=True):
+        spans = sorted(snapshot["spans"].items(), key=lambda item: -item[1]["seconds"])
+        st.dataframe(
+            [{"span": name, "seconds": round(entry["seconds"], 4), "calls": entry["calls"]} for name, entry in spans],
+            use_container_width=True
+        )
+        st.json(snapshot["counters"])
+        for name, text in snapshot["profiles"].items():
+            st.caption(name)
+            st.code(text)
 
 def main():
+    setup_page()
+    get_image_prefetcher()
+
     # App Title and Description
     st.title("🎧 LoFi Studio")
     st.markdown("### Generate Your Own Chill Tracks")
@@ -134,6 +245,34 @@ def main():
             step=10
         )
 
+        seed_input = st.number_input(
+            "Seed (0 = random)",
+            min_value=0,
+            max_value=2**31 - 1,
+            value=0,
+            step=1,
+            help="Reuse a seed to get the same track and picture again"
+        )
+
+        image_source = st.selectbox(
+            "Background",
+            IMAGE_SOURCES,
+            format_func=IMAGE_SOURCE_LABELS.get,
+            help="Procedural backgrounds are drawn locally and need no network"
+        )
+
+        video_mode = st.selectbox(
+            "Video Style",
+            VIDEO_MODES,
+            format_func=VIDEO_MODE_LABELS.get,
+            help="The visualizer animates spectrum bars to the music and takes longer to render"
+        )
+
+        debug = st.checkbox("Debug metrics", help="Show per-stage timings and counters after each render")
+        profiler = None
+        if debug:
+            profiler = st.selectbox("Profiler", [None] + PROFILERS, format_func=lambda p: p or "off")
+
         st.markdown("---")
         st.markdown("Powered by **LoFi Studio Engine**")
 
@@ -141,45 +280,67 @@ def main():
     # Placeholder for content
     if 'generated' not in st.session_state:
         st.session_state.generated = False
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None
 
-    # Generate Button
-    if st.button("Generate Track", use_container_width=True):
-        with st.spinner("Entering the studio..."):
-            generate_content(track_length, music_type)
+    # Generate Buttons
+    preview_col, generate_col = st.columns(2)
+    with preview_col:
+        preview = st.button("Quick Preview", use_container_width=True,
+                            help=f"Hear a {PREVIEW_SEC} s draft now while the full track renders")
+    with generate_col:
+        generate = st.button("Generate Track", use_container_width=True, disabled=bool(st.session_state.job_id))
+    if preview or generate:
+        seed = int(seed_input) or random.randrange(1, 2**31)
+        if preview:
+            preview_content(track_length, music_type, seed, image_source, video_mode, profiler)
+        else:
+            generate_content(track_length, music_type, seed, image_source, video_mode, profiler)
+
+    if st.session_state.get('preview_path') and not st.session_state.generated:
+        st.caption(f"Draft preview · seed {st.session_state.preview_seed}")
+        st.audio(media(st.session_state.preview_path), format="audio/mpeg")
+
+    if st.session_state.job_id:
+        show_job_progress()
+
+    if debug and st.session_state.get('metrics'):
+        show_metrics(st.session_state.metrics)
 
     # Display Results
     if st.session_state.generated:
         st.markdown("---")
+        st.caption(f"Seed: {st.session_state.get('seed')}")
         
         # Show Visuals
         if st.session_state.get('image_path') and os.path.exists(st.session_state.image_path):
-            st.image(st.session_state.image_path, caption=f"Vibe: {music_type}", use_container_width=True)
+            st.image(media(st.session_state.image_path), caption=f"Vibe: {music_type}", use_container_width=True)
         
         # Audio Player
         if st.session_state.get('audio_path') and os.path.exists(st.session_state.audio_path):
             st.markdown("#### 🎧 Preview Audio")
-            st.audio(st.session_state.audio_path)
+            st.audio(media(st.session_state.audio_path), format="audio/mpeg")
             
-            with open(st.session_state.audio_path, "rb") as f:
-                st.download_button(
-                    label="Download Audio (MP3)",
-                    data=f,
-                    file_name=f"lofi_studio_{music_type.lower().replace(' ', '_')}.mp3",
-                    mime="audio/mpeg"
-                )
+            download_button(
+                "Download Audio (MP3)",
+                st.session_state.audio_path,
+                f"lofi_studio_{music_type.lower().replace(' ', '_')}.mp3",
+                "audio/mpeg"
+            )
 
         # Video Download
         if st.session_state.get('video_path') and os.path.exists(st.session_state.video_path):
             st.markdown("#### 🎬 Final Video")
-            st.video(st.session_state.video_path)
+            st.video(media(st.session_state.video_path), format="video/mp4")
             
-            with open(st.session_state.video_path, "rb") as f:
-                st.download_button(
-                    label="Download Video (MP4)",
-                    data=f,
-                    file_name=f"lofi_studio_{music_type.lower().replace(' ', '_')}.mp4",
-                    mime="video/mp4"
-                )
+            download_button(
+                "Download Video (MP4)",
+                st.session_state.video_path,
+                f"lofi_studio_{music_type.lower().replace(' ', '_')}.mp4",
+                "video/mp4"
+            )
+
+    start_warm_up()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import metrics
+
+# Content-addressed store for rendered artifacts (WAV/MP3/MP4/images). Files live
+# at <root>/<key[:2]>/<key><ext>, are written to a temp file and renamed into
+# place, and are evicted least-recently-used once the store is too big or too old.
+
+DEFAULT_ROOT = "assets/cache"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+# A partial file untouched for this long was left by a build that died
+PARTIAL_STALE_SEC = 60
+
+def artifact_key(kind, **params):
+    # Stable hash of everything that determines an artifact's content
+    payload = json.dumps({"kind": kind, **params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+class ArtifactCache:
+    def __init__(self, root=DEFAULT_ROOT, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def path(self, key, ext):
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def partial_path(self, key, ext):
+        # Where a partial=True build writes its draft while it runs; dot-prefixed like every temp file
+        return os.path.join(self.root, key[:2], f".{key}.partial{ext}")
+
+    def _claim_partial(self, key, ext):
+        # Create the partial file, taking over a stale one. None if a live build
+        # already owns it.
+        path = self.partial_path(key, ext)
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return path
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < PARTIAL_STALE_SEC:
+                        return None
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return None
+
+    def get(self, key, ext):
+        # Cached path or None; a hit refreshes the entry's LRU position
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_or_create(self, key, ext, create, partial=False):
+        # Return the cached artifact, or build it with create(tmp_path) and move
+        # it into place atomically. Concurrent builders of the same key each
+        # write their own temp file and the last rename wins. With partial=True
+        # it is create(tmp_path, partial_path): the first builder also gets
+        # partial_path() to write a draft to as it goes, for others to read
+        # (None for the rest), and the draft is removed once the artifact is in place.
+        path = self.get(key, ext)
+        if path:
+            metrics.count("cache_hits")
+            return path
+
+        metrics.count("cache_misses")
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{key}.", suffix=ext, dir=os.path.dirname(path))
+        os.close(fd)
+        partial_path = self._claim_partial(key, ext) if partial else None
+        try:
+            if partial:
+                create(tmp_path, partial_path)
+            else:
+                create(tmp_path)
+            metrics.count("cache_bytes_stored", os.path.getsize(tmp_path))
+            os.replace(tmp_path, path)
+        finally:
+            for leftover in (tmp_path, partial_path):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+        self.evict(keep=path)
+        return path
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, name.startswith("."), stat.st_size, stat.st_mtime
+
+    def evict(self, keep=None):
+        # Drop entries older than max_age, then least recently used ones until the
+        # store fits in max_bytes. Temp files are only removed once stale.
+        now = time.time()
+        live = []
+        for path, is_tmp, size, mtime in self._entries():
+            if now - mtime > self.max_age and path != keep:
+                self._remove(path)
+            elif not is_tmp:
+                live.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in live)
+        for _, size, path in sorted(live):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+                total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def size(self):
+        return sum(size for _, is_tmp, size, _ in self._entries() if not is_tmp)
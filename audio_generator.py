@@ -1,46 +1,110 @@
+import itertools
 import numpy as np
-import scipy.io.wavfile as wavfile
 import random
 import os
+import time
+import wave
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from voice_cache import VoiceCache
+from oscillators import oscillate
+import cancellation
+import dsp
+import metrics
+from mixer import BUS_KEYS, BUS_MELODY, BUS_DRUMS, BUS_CRACKLE, N_BUSES, NOISE_PEAK, build_mixer
 
 SAMPLE_RATE = 44100
 
-def generate_sine_wave(freq, duration, amplitude=0.5):
-    t = np.linspace(0, duration, int(SAMPLE_RATE * duration), endpoint=False)
-    wave = amplitude * np.sin(2 * np.pi * freq * t)
+# Waveform codes used in compiled event lists
+WAVE_SINE = 0
+WAVE_SQUARE = 1
+WAVE_NOISE = 2
+WAVE_SAW = 3
+WAVE_RHODES = 4
+WAVE_PAD = 5
+
+# Wavetable used for each pitched waveform code
+WAVE_SHAPES = {
+    WAVE_SINE: "sine",
+    WAVE_SQUARE: "square",
+    WAVE_SAW: "saw",
+    WAVE_RHODES: "rhodes",
+    WAVE_PAD: "pad",
+}
+
+# One row per note or drum hit, produced by compile_arrangement and mixed by render_events
+EVENT_DTYPE = np.dtype([
+    ("onset", np.int64),    # start sample in the track
+    ("length", np.int32),   # note length in samples
+    ("freq", np.float64),
+    ("wave", np.uint8),     # WAVE_* code
+    ("attack", np.int32),   # envelope attack in samples
+    ("release", np.int32),  # envelope release in samples
+    ("gain", np.float32),
+    ("delay", np.int32),    # echo offset in samples, 0 = dry
+    ("decay", np.float32),  # echo level
+    ("variant", np.uint8),  # noise pool index for WAVE_NOISE hits
+    ("bus", np.uint8),      # mixer.BUS_* the event is routed to
+])
+
+# Fields that fully determine how an event sounds, i.e. its voice cache key
+VOICE_FIELDS = ["wave", "freq", "length", "gain", "attack", "release", "delay", "decay", "variant"]
+
+# Noise hits are drawn from this many pre-seeded variants so they can be cached
+NOISE_VARIANTS = 8
+
+# Shared cache of rendered voices
+VOICE_CACHE = VoiceCache()
+
+# Upper bound on rows * length synthesized in one batch
+BATCH_SAMPLES = 1 << 20
+
+# Samples per block in streaming mode (~3 s)
+STREAM_BLOCK = 1 << 17
+
+# Streaming renders can't wait for the whole mix to find its peak. They set
+# their gain from the first PREROLL_SEC of it, leaving PREROLL_MARGIN for
+# louder passages later on, and a look-ahead limiter catches whatever still
+# goes over. (plan["peak_bound"] is far too loose to set a level from: it adds
+# up every note peak as if they all lined up.)
+PREROLL_SEC = 10
+PREROLL_MARGIN = 10 ** (1.5 / 20)
+LIMIT_CEILING = 0.95
+LIMIT_LOOKAHEAD_SEC = 0.005
+LIMIT_RELEASE_SEC = 0.25
+
+# Level of the vinyl crackle bed
+CRACKLE_AMPLITUDE = 0.015
+
+# Source for generate_noise; track renders draw crackle from per-segment seeded streams
+NOISE_RNG = np.random.default_rng()
+
+def generate_wave(shape, freq, duration, amplitude=0.5):
+    # Any oscillators.SHAPES entry: "sine", "square", "saw", "rhodes", "pad"
+    wave = oscillate(shape, freq, int(SAMPLE_RATE * duration))[0]
+    wave *= amplitude
     return wave
 
+def generate_sine_wave(freq, duration, amplitude=0.5):
+    return generate_wave("sine", freq, duration, amplitude)
+
 def generate_square_wave(freq, duration, amplitude=0.5):
-    t = np.linspace(0, duration, int(SAMPLE_RATE * duration), endpoint=False)
-    wave = amplitude * np.sign(np.sin(2 * np.pi * freq * t))
-    return wave
+    # Band-limited, so high notes no longer alias
+    return generate_wave("square", freq, duration, amplitude)
 
 def generate_noise(duration, amplitude=0.1):
-    return np.random.normal(0, amplitude, int(SAMPLE_RATE * duration))
+    noise = NOISE_RNG.standard_normal(int(SAMPLE_RATE * duration), dtype=dsp.DTYPE)
+    noise *= amplitude
+    return noise
+
+# envelope and apply_delay return new arrays; use dsp directly to work in place
 
 def envelope(wave, attack=0.01, release=0.5):
-    total_samples = len(wave)
-    attack_samples = min(int(attack * SAMPLE_RATE), total_samples // 2)
-    release_samples = min(int(release * SAMPLE_RATE), total_samples // 2)
-    
-    env = np.ones(total_samples)
-    
-    # Attack
-    if attack_samples > 0:
-        env[:attack_samples] = np.linspace(0, 1, attack_samples)
-    
-    # Release
-    if release_samples > 0:
-        env[-release_samples:] = np.linspace(1, 0, release_samples)
-        
-    return wave * env
+    return dsp.envelope(np.array(wave, dtype=dsp.DTYPE), int(attack * SAMPLE_RATE), int(release * SAMPLE_RATE))
 
 def apply_delay(wave, delay_sec=0.3, decay=0.5):
-    delay_samples = int(delay_sec * SAMPLE_RATE)
-    new_wave = np.zeros(len(wave) + delay_samples)
-    new_wave[:len(wave)] = wave
-    new_wave[delay_samples:] += wave * decay
-    return new_wave[:len(wave)] # Truncate to original length
+    # Truncated to the original length
+    return dsp.apply_delay(np.array(wave, dtype=dsp.DTYPE), int(delay_sec * SAMPLE_RATE), decay)
 
 def get_scale(root_freq, scale_type="Major"):
     # Ratios from root
@@ -56,246 +120,572 @@ def get_scale(root_freq, scale_type="Major"):
     
     return [root_freq * r for r in selected_ratios]
 
-def generate_lofi_track(duration_sec, style="Lo-Fi Beats", output_filename="assets/generated/generated_track.wav"):
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+# Keys a track can be in: C4, A3, G3, F3
+ROOT_FREQS = [261.63, 220.00, 196.00, 174.61]
 
-    # Base track (silence)
-    total_samples = int(SAMPLE_RATE * duration_sec)
-    track = np.zeros(total_samples)
-    
-    # 1. Add Vinyl Crackle (Pink/White noise low amplitude)
-    track += generate_noise(duration_sec, 0.015)
-    
+def get_style_settings(style, rng=random):
     # Determine musical parameters based on style
-    root_freq_choice = random.choice([261.63, 220.00, 196.00, 174.61]) # C4, A3, G3, F3
-    
-    scale_type = "Major"
-    bpm = 75
-    instrument_decay = 0.8
-    wave_func = generate_sine_wave
-    use_delay = False
-    
+    settings = {
+        "root_freq": rng.choice(ROOT_FREQS),
+        "scale_type": "Major",
+        "bpm": 75,
+        "instrument_decay": 0.8,
+        "wave": WAVE_SINE,
+        "use_delay": False,
+    }
+
     if style == "Lo-Fi Beats":
-        scale_type = "Minor"
-        bpm = random.choice([70, 75, 80, 85])
-        instrument_decay = 1.0
-        wave_func = generate_sine_wave # Soft sine for 'keys'
-        
+        settings.update(scale_type="Minor", bpm=rng.choice([70, 75, 80, 85]), instrument_decay=1.0, wave=WAVE_RHODES) # Soft Rhodes for 'keys'
     elif style == "Piano":
-        scale_type = "Major"
-        bpm = random.choice([60, 65, 70])
-        instrument_decay = 2.0
-        wave_func = generate_sine_wave
-
+        settings.update(scale_type="Major", bpm=rng.choice([60, 65, 70]), instrument_decay=2.0)
     elif style == "Ambient":
-        scale_type = "Dorian"
-        bpm = 60
-        instrument_decay = 4.0
-        use_delay = True
-        
+        settings.update(scale_type="Dorian", bpm=60, instrument_decay=4.0, wave=WAVE_PAD, use_delay=True)
     elif style == "Synth":
-        scale_type = "Pentatonic"
-        bpm = 90
-        instrument_decay = 0.5
-        wave_func = generate_square_wave # Gritty square wave
-        use_delay = True
-
+        settings.update(scale_type="Pentatonic", bpm=90, instrument_decay=0.5, wave=WAVE_SQUARE, use_delay=True) # Gritty square wave
     elif style == "Jazz Hop":
-        scale_type = "Dorian"
-        bpm = 85
-        instrument_decay = 0.8
-        wave_func = generate_sine_wave
-        use_delay = False
-    
+        settings.update(scale_type="Dorian", bpm=85, instrument_decay=0.8, wave=WAVE_RHODES)
     elif style == "Meditation":
-        scale_type = "Pentatonic"
-        bpm = 40
-        instrument_decay = 5.0 # Very long pads
-        wave_func = generate_sine_wave
-        use_delay = True
-        
+        settings.update(scale_type="Pentatonic", bpm=40, instrument_decay=5.0, wave=WAVE_PAD, use_delay=True) # Very long pads
     elif style == "8-Bit":
-        scale_type = "Major"
-        bpm = 120
-        instrument_decay = 0.3 # Plucky
-        wave_func = generate_square_wave
-        use_delay = False
+        settings.update(scale_type="Major", bpm=120, instrument_decay=0.3, wave=WAVE_SQUARE) # Plucky
+
+    return settings
+
+def compile_arrangement(duration_sec, style="Lo-Fi Beats", rng=random, settings=None):
+    # Phase 1: turn the arrangement into a flat EVENT_DTYPE array sorted by onset.
+    # No audio is synthesized here, so this stays cheap even for long tracks.
+    if settings is None:
+        settings = get_style_settings(style, rng)
+
+    total_samples = int(SAMPLE_RATE * duration_sec)
+    scale = get_scale(settings["root_freq"], settings["scale_type"])
+    instrument_decay = settings["instrument_decay"]
+    wave_code = settings["wave"]
+    events = []
+
+    def add(bus, time_sec, dur, freq, wave, amplitude, attack, release, delay_sec=0.0, decay=0.0):
+        length = int(SAMPLE_RATE * dur)
+        if length <= 0:
+            return
+        variant = rng.randrange(NOISE_VARIANTS) if wave == WAVE_NOISE else 0
+        events.append((
+            int(time_sec * SAMPLE_RATE), length, freq, wave,
+            min(int(attack * SAMPLE_RATE), length // 2),
+            min(int(release * SAMPLE_RATE), length // 2),
+            amplitude, int(delay_sec * SAMPLE_RATE), decay, variant, bus,
+        ))
+
+    def add_hit(time_sec, dur, freq, wave, amplitude, attack, release):
+        # Drum hits that would run past the end are dropped rather than truncated
+        if int(time_sec * SAMPLE_RATE) + int(SAMPLE_RATE * dur) <= total_samples:
+            add(BUS_DRUMS, time_sec, dur, freq, wave, amplitude, attack, release)
 
-    scale = get_scale(root_freq_choice, scale_type)
-    
     # 2. Chord Progression / Melody
+    phase_start = time.perf_counter()
     current_time = 0
-    beat_dur = 60 / bpm
-    
+    beat_dur = 60 / settings["bpm"]
+
     # 4-bar loop length in seconds
     bar_length = beat_dur * 4
-    
+
     while current_time < duration_sec:
         # Determine chord duration (1 bar or 1/2 bar)
         measure_rem = bar_length - (current_time % bar_length)
-        step_duration = min(measure_rem, random.choice([beat_dur, beat_dur*2]))
-        
+        step_duration = min(measure_rem, rng.choice([beat_dur, beat_dur*2]))
+
         if style == "Meditation":
             step_duration = bar_length # Long drones
-            
+
         if current_time + step_duration > duration_sec:
             step_duration = duration_sec - current_time
-            
+
         if step_duration <= 0.05: break # Avoid tiny clips at end
 
         # Pick a random root note from scale low end
-        root_idx = random.randint(0, 3) 
-        
+        root_idx = rng.randint(0, 3)
+
         # Build chord (Root, 3rd, 5th)
         chord_indices = [root_idx, (root_idx+2)%len(scale), (root_idx+4)%len(scale)]
-        chord_freqs = [scale[i] for i in chord_indices]
-        
+
         if style == "Jazz Hop":
-             # Add a 7th note for jazz feel
-             chord_indices.append((root_idx+6)%len(scale))
-             chord_freqs = [scale[i] for i in chord_indices]
+            # Add a 7th note for jazz feel
+            chord_indices.append((root_idx+6)%len(scale))
+        chord_freqs = [scale[i] for i in chord_indices]
 
         # Random Melody Note (higher pitch)
         melody_note = None
-        if random.random() > 0.3 and style != "Meditation":
-            melody_note = scale[random.randint(3, len(scale)-1)] * (2 if random.random()>0.7 else 1)
-        elif style == "Meditation" and random.random() > 0.7:
-             # Occasional chime
-             melody_note = scale[random.randint(4, len(scale)-1)] * 2
+        if rng.random() > 0.3 and style != "Meditation":
+            melody_note = scale[rng.randint(3, len(scale)-1)] * (2 if rng.random()>0.7 else 1)
+        elif style == "Meditation" and rng.random() > 0.7:
+            # Occasional chime
+            melody_note = scale[rng.randint(4, len(scale)-1)] * 2
 
-        # Generate Chord Audio
+        # Chord events
         for freq in chord_freqs:
             # Randomize decay slightly for human feel
-            this_decay = instrument_decay * random.uniform(0.8, 1.2)
-            
-            note_dur = step_duration 
+            # (rounded to 10 ms so repeated chord tones can share a cached voice)
+            this_decay = round(instrument_decay * rng.uniform(0.8, 1.2), 2)
+
+            note_dur = step_duration
             if style in ["Ambient", "Meditation"]: note_dur += 3.0 # Let it ring overlap
-            
-            wave = wave_func(freq, note_dur, 0.15)
-            
+
             # Specific Envelopes
             if style == "Meditation":
-                 wave = envelope(wave, attack=1.0, release=3.0)
+                attack, release = 1.0, 3.0
             elif style == "8-Bit":
-                 wave = envelope(wave, attack=0.01, release=0.2)
-            else:
-                 wave = envelope(wave, attack=0.05, release=min(this_decay, note_dur))
-            
-            if use_delay:
-                wave = apply_delay(wave, 0.4, 0.4)
-            
-            # Mix into track
-            start_sample = int(current_time * SAMPLE_RATE)
-            end_sample = start_sample + len(wave)
-            
-            if end_sample > total_samples:
-                # Truncate wave to fit end of track
-                valid_len = total_samples - start_sample
-                if valid_len > 0:
-                    track[start_sample:] += wave[:valid_len]
+                attack, release = 0.01, 0.2
             else:
-                track[start_sample:end_sample] += wave
-                
-        # Generate Melody Audio choice
+                attack, release = 0.05, min(this_decay, note_dur)
+
+            add(BUS_KEYS, current_time, note_dur, freq, wave_code, 0.15, attack, release)
+
+        # Melody event
         if melody_note:
-            mel_start_offset = random.choice([0, beat_dur/2, beat_dur])
+            mel_start_offset = rng.choice([0, beat_dur/2, beat_dur])
             if style == "Jazz Hop":
-                 # Swing feel: delay off-beats slightly
-                 if mel_start_offset == beat_dur/2:
-                      mel_start_offset += 0.05 
-                      
+                # Swing feel: delay off-beats slightly
+                if mel_start_offset == beat_dur/2:
+                    mel_start_offset += 0.05
+
             mel_dur = step_duration - mel_start_offset
-            if mel_dur > 0: 
-                wave = wave_func(melody_note, mel_dur, 0.1)
-                
+            if mel_dur > 0:
                 if style == "Meditation":
-                     wave = envelope(wave, 0.5, 2.0)
+                    attack, release = 0.5, 2.0
                 elif style == "8-Bit":
-                     wave = envelope(wave, 0.01, 0.1) # Staccato
+                    attack, release = 0.01, 0.1 # Staccato
                 else:
-                     wave = envelope(wave, 0.02, 0.3)
-                     
-                if use_delay: wave = apply_delay(wave, 0.25, 0.3)
-                
-                start_s = int((current_time + mel_start_offset) * SAMPLE_RATE)
-                end_s = start_s + len(wave)
-                if end_s <= total_samples:
-                    track[start_s:end_s] += wave
-                elif start_s < total_samples:
-                     track[start_s:] += wave[:total_samples-start_s]
+                    attack, release = 0.02, 0.3
+
+                add(BUS_MELODY, current_time + mel_start_offset, mel_dur, melody_note, wave_code, 0.1, attack, release)
 
         current_time += step_duration
+    # One lap for both: chords and melody are drawn step by step from one rng,
+    # and pulling them into separate loops would change every seed's track
+    metrics.lap("arrange.chords_melody", phase_start)
 
     # 3. Add Drums
+    phase_start = time.perf_counter()
     if style in ["Lo-Fi Beats", "Synth", "Jazz Hop", "8-Bit"]:
         current_beat = 0
         while current_beat < duration_sec:
             # Kick on 1
-            if current_beat < duration_sec:
-                kick_dur = 0.15
-                kick_freq = 55
-                if style == "8-Bit": kick_dur = 0.1; kick_freq = 80 # Punchier
-                
-                kick = generate_sine_wave(random.choice([kick_freq, kick_freq+5]), kick_dur, 0.5)
-                if style == "8-Bit": kick = generate_square_wave(kick_freq, kick_dur, 0.4) # Chiptune kick
-                
-                kick = envelope(kick, 0.01, 0.1)
-                start = int(current_beat * SAMPLE_RATE)
-                end = start + len(kick)
-                if end <= total_samples: track[start:end] += kick
-            
-            # Snare/Clap on 2 
+            kick_dur = 0.15
+            kick_freq = 55
+            if style == "8-Bit": kick_dur = 0.1; kick_freq = 80 # Punchier
+
+            kick_choice = rng.choice([kick_freq, kick_freq+5])
+            if style == "8-Bit":
+                add_hit(current_beat, kick_dur, kick_freq, WAVE_SQUARE, 0.4, 0.01, 0.1) # Chiptune kick
+            else:
+                add_hit(current_beat, kick_dur, kick_choice, WAVE_SINE, 0.5, 0.01, 0.1)
+
+            # Snare/Clap on 2
             snare_time = current_beat + beat_dur
             if style == "Jazz Hop":
-                 # Slight laid back snare
-                 snare_time += 0.03
-                 
+                # Slight laid back snare
+                snare_time += 0.03
+
             if snare_time < duration_sec:
-                snare_dur = 0.1
-                snare = generate_noise(snare_dur, 0.25)
-                if style == "8-Bit": snare = generate_noise(0.05, 0.3) # Short noise burst
-                
-                snare = envelope(snare, 0.005, 0.08)
-                start = int(snare_time * SAMPLE_RATE)
-                end = start + len(snare)
-                if end <= total_samples: track[start:end] += snare
-            
+                if style == "8-Bit":
+                    add_hit(snare_time, 0.05, 0.0, WAVE_NOISE, 0.3, 0.005, 0.08) # Short noise burst
+                else:
+                    add_hit(snare_time, 0.1, 0.0, WAVE_NOISE, 0.25, 0.005, 0.08)
+
             # Hi-hats
             hat_subdiv = 4 # 16th notes
-            if style == "Jazz Hop": hat_subdiv = 3 # Triplet feel sometimes? Or just swing 8ths
-            
+            if style == "Jazz Hop": hat_subdiv = 3 # Swing 8ths
+
             for i in range(hat_subdiv):
-                hat_time = current_beat + (i * (beat_dur/(hat_subdiv/2))) # Wait logic check..
-                # Simple 8th notes: 0, 0.5
-                # 16th notes: 0, 0.25, 0.5, 0.75
-                
                 if style == "Jazz Hop":
-                     # Swing 8ths
-                     if i == 0: hat_time = current_beat
-                     elif i == 1: hat_time = current_beat + (beat_dur * 0.66) # Swing
-                     else: continue
+                    # Swing 8ths
+                    if i == 0: hat_time = current_beat
+                    elif i == 1: hat_time = current_beat + (beat_dur * 0.66) # Swing
+                    else: continue
                 else:
-                     hat_time = current_beat + (i * (beat_dur/2))
+                    hat_time = current_beat + (i * (beat_dur/2))
 
                 if hat_time < duration_sec:
-                    if random.random() > 0.2: 
-                        hat_dur = 0.05
-                        hat = generate_noise(hat_dur, 0.1)
-                        if style == "8-Bit": hat = generate_square_wave(800, 0.03, 0.1) # Blip hat
-                        
-                        hat = envelope(hat, 0.002, 0.03)
-                        start = int(hat_time * SAMPLE_RATE)
-                        end = start + len(hat)
-                        if end <= total_samples: track[start:end] += hat
+                    if rng.random() > 0.2:
+                        if style == "8-Bit":
+                            add_hit(hat_time, 0.03, 800, WAVE_SQUARE, 0.1, 0.002, 0.03) # Blip hat
+                        else:
+                            add_hit(hat_time, 0.05, 0.0, WAVE_NOISE, 0.1, 0.002, 0.03)
 
             current_beat += beat_dur * 2
+    metrics.lap("arrange.drums", phase_start)
+
+    events = np.array(events, dtype=EVENT_DTYPE)
+    return events[np.argsort(events["onset"], kind="stable")]
+
+def _synthesize(batch):
+    # Render a batch of events sharing wave, length and delay as one 2D array
+    code = batch["wave"][0]
+    length = int(batch["length"][0])
+    gain = batch["gain"][:, None]
+
+    if code == WAVE_NOISE:
+        # Each variant is its own seeded stream, so a hit sounds the same whether
+        # or not it was cached
+        waves = np.empty((len(batch), length), dtype=dsp.DTYPE)
+        for row, variant in zip(waves, batch["variant"].tolist()):
+            np.random.default_rng(variant).standard_normal(dtype=dsp.DTYPE, out=row)
+    else:
+        waves = oscillate(WAVE_SHAPES[code], batch["freq"], length)
+    waves *= gain
+
+    for row, attack, release in zip(waves, batch["attack"].tolist(), batch["release"].tolist()):
+        dsp.envelope(row, attack, release)
+    dsp.apply_delay(waves, batch["delay"][0], batch["decay"][0])
+    return waves
+
+def _voices(voices, cache):
+    # Rendered waves for a group of distinct voices sharing a shape; cache misses
+    # are synthesized together in bounded batches
+    waves = [None] * len(voices)
+    keys = voices.tolist()
+    if cache is not None:
+        waves = [cache.get(key) for key in keys]
+    missing = np.array([i for i, row in enumerate(waves) if row is None], dtype=np.intp)
+
+    metrics.count("voices_synthesized", len(missing))
+    rows = max(1, BATCH_SAMPLES // int(voices["length"][0]))
+    for start in range(0, len(missing), rows):
+        idx = missing[start:start + rows]
+        for i, row in zip(idx.tolist(), _synthesize(voices[idx])):
+            waves[i] = cache.put(keys[i], row.copy()) if cache is not None else row
+    return waves
+
+def _scatter(out, waves, starts, buses):
+    # Slice-add each row; for rows this long it is far cheaper than np.add.at
+    for start, row, bus in zip(starts.tolist(), waves, buses.tolist()):
+        dsp.mix_into(out[bus] if out.ndim == 2 else out, row, start)
+
+def render_events(events, out, offset=0, cache=VOICE_CACHE):
+    # Phase 2: mix compiled events into out, where out[..., 0] is track sample
+    # `offset`. A 2D out is an (N_BUSES, n) block and each event lands on its bus.
+    # Events sharing a shape are grouped, repeated voices are rendered once (or
+    # served from the cache) and the rest are synthesized together in batches.
+    if len(events) == 0:
+        return out
+
+    start = time.perf_counter()
+    metrics.count("notes_rendered", len(events))
+    shape_fields = ["wave", "length", "delay", "decay"]
+    events = events[np.lexsort([events[f] for f in reversed(shape_fields)])]
+    shapes = events[shape_fields]
+    bounds = np.concatenate(([0], np.flatnonzero(shapes[1:] != shapes[:-1]) + 1, [len(events)]))
+
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        group = events[lo:hi]
+        voices, which = np.unique(group[VOICE_FIELDS], return_inverse=True)
+        waves = _voices(voices, cache)
+        _scatter(out, [waves[i] for i in which.ravel().tolist()], group["onset"] - offset, group["bus"])
+    metrics.lap("synthesize", start)
+    return out
+
+def peak_bound(events, noise_amplitude=0.0):
+    # Upper bound on |track|: the loudest sum of event peaks sounding at once.
+    # Lets streaming renders pick their gain up front instead of scanning for a max.
+    if len(events) == 0:
+        return noise_amplitude * NOISE_PEAK
+    peaks = events["gain"].astype(np.float64) * (1 + events["decay"])
+    peaks[events["wave"] == WAVE_NOISE] *= NOISE_PEAK
+    edges = np.concatenate((events["onset"], events["onset"] + events["length"]))
+    steps = np.concatenate((peaks, -peaks))
+    # Note-offs sort before note-ons on the same sample
+    running = np.cumsum(steps[np.lexsort((steps, edges))])
+    return running.max() + noise_amplitude * NOISE_PEAK
+
+def _arrangement_rng(seed_seq):
+    # compile_arrangement speaks the `random` module API, so seed a random.Random
+    return random.Random(int.from_bytes(seed_seq.generate_state(4).tobytes(), "little"))
+
+def segment_rng(seed_seq, index):
+    # Noise stream for segment (or phrase) `index`, independent of render order
+    return np.random.default_rng(np.random.SeedSequence(seed_seq.entropy, spawn_key=seed_seq.spawn_key + (index,)))
+
+def segment_bounds(total_samples, bar_sec, block_size=STREAM_BLOCK):
+    # Segment start samples on bar lines, each about block_size long, closed by total_samples
+    step = bar_sec * max(1, round(block_size / (bar_sec * SAMPLE_RATE)))
+    bounds = []
+    k = 0
+    while int(k * step * SAMPLE_RATE) < total_samples:
+        bounds.append(int(k * step * SAMPLE_RATE))
+        k += 1
+    return bounds + [total_samples]
+
+def render_segment(events, start, length, noise_seq, index):
+    # Dry (N_BUSES, >= length) buffer for one segment: the given events rendered
+    # in full, so the buffer runs on past `length` by their tails, plus the
+    # segment's crackle. Top level so process pools can pickle it.
+    end = int((events["onset"] + events["length"]).max()) - start if len(events) else 0
+    buf = np.zeros((N_BUSES, max(length, end)), dtype=dsp.DTYPE)
+    render_events(events, buf, offset=start)
+    dsp.add_noise(buf[BUS_CRACKLE, :length], CRACKLE_AMPLITUDE, segment_rng(noise_seq, index))
+    return buf
+
+def mix_segment(events, start, length, noise_seq, index, mixer):
+    # mixer.render() of samples [start, start + length) on their own, rung out
+    # past the end. `events` are all those sounding in the segment, begun in it
+    # or earlier; only their part inside it is rendered. Top level so process
+    # pools can pickle it.
+    buf = np.zeros((N_BUSES, length), dtype=dsp.DTYPE)
+    render_events(events, buf, offset=start)
+    dsp.add_noise(buf[BUS_CRACKLE], CRACKLE_AMPLITUDE, segment_rng(noise_seq, index))
+    with metrics.span("mix"):
+        return mixer.render(buf)
+
+def _ordered_map(executor, fn, jobs, window):
+    # executor.map with at most `window` results in flight, so memory stays bounded
+    pending = deque()
+    for job in jobs:
+        pending.append(executor.submit(fn, *job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def segment_blocks(events, bounds, mixer, noise_seq, executor=None, window=4):
+    # Yield the mix one segment at a time. Each segment is synthesized and mixed
+    # on its own (mix_segment), notes carried over from earlier segments
+    # included, so all that passes between segments is the mixer's ring,
+    # overlap-added here into the ones after. With an executor the segments
+    # render and mix in parallel and this process only does that overlap-add
+    # and the streamed returns (the feedback delay); the result is
+    # bit-identical to a serial render.
+    onsets = events["onset"]
+    ends = onsets + events["length"]
+    longest = int(events["length"].max()) if len(events) else 0
+    jobs = []
+    for index, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        lo, hi = np.searchsorted(onsets, [start - longest, end])
+        sounding = events[lo:hi][ends[lo:hi] > start]
+        jobs.append((sounding, start, end - start, noise_seq, index, mixer))
+
+    if executor is None:
+        segments = (mix_segment(*job) for job in jobs)
+    else:
+        segments = _ordered_map(executor, mix_segment, jobs, window)
+
+    carry = np.zeros((1 + len(mixer.streamed), 0), dtype=dsp.DTYPE)
+    for job, rendered in zip(jobs, segments):
+        length = job[2]
+        rendered[:, :carry.shape[1]] += carry
+        carry = rendered[:, length:]
+        with metrics.span("mix"):
+            block = mixer.finish(rendered[:, :length])
+        yield block
 
-    # Normalize
-    max_val = np.max(np.abs(track))
-    if max_val > 0:
-        track = track / max_val * 0.95
-        
-    track_int16 = (track * 32767).astype(np.int16)
-    wavfile.write(output_filename, SAMPLE_RATE, track_int16)
+def render_phrase(n_bars, style, settings, rng=random, noise_rng=NOISE_RNG):
+    # Render an n_bars phrase (per bus, with its own crackle). Returns (buffer,
+    # period) where the buffer runs past `period` samples by however long the
+    # last notes ring.
+    phrase_sec = 60 / settings["bpm"] * 4 * n_bars
+    period = int(SAMPLE_RATE * phrase_sec)
+    events = compile_arrangement(phrase_sec, style, rng, settings)
+
+    tail = max(0, int((events["onset"] + events["length"]).max()) - period) if len(events) else 0
+    phrase = np.zeros((N_BUSES, period + tail), dtype=dsp.DTYPE)
+    dsp.add_noise(phrase[BUS_CRACKLE, :period], CRACKLE_AMPLITUDE, noise_rng)
+    render_events(events, phrase)
+    return phrase, period
+
+def quantize_tempo(settings, n_bars, quantum):
+    # Nudge the tempo (by well under 1%) so an n_bars phrase lasts an exact
+    # multiple of `quantum` samples. Aim half a sample past the target so the
+    # int() in render_phrase lands on it despite float error.
+    period = SAMPLE_RATE * 240 * n_bars / settings["bpm"]
+    target = max(1, round(period / quantum)) * quantum
+    return dict(settings, bpm=SAMPLE_RATE * 240 * n_bars / (target + 0.5))
+
+def phrase_cycle(variations):
+    # Phrases before _phrase_index repeats itself
+    return 4 * variations if variations else 1
+
+def _phrase_index(k, count):
+    # The main phrase (index 0) plays three times, then a variation, cycling
+    # through the variations in order
+    if count > 1 and k % 4 == 3:
+        return 1 + (k // 4) % (count - 1)
+    return 0
+
+def tiled_blocks(phrases, period, total_samples, block_size=STREAM_BLOCK):
+    # Yield blocks made by overlap-adding the (rows, n) phrases every `period` samples
+    longest = max(phrase.shape[-1] for phrase in phrases)
+    for block_start in range(0, total_samples, block_size):
+        n = min(block_size, total_samples - block_start)
+        block = np.zeros((phrases[0].shape[0], n), dtype=dsp.DTYPE)
+        first = max(0, (block_start - longest) // period)
+        for k in range(first, (block_start + n - 1) // period + 1):
+            phrase = phrases[_phrase_index(k, len(phrases))]
+            dsp.mix_into(block, phrase, k * period - block_start)
+        yield block
+
+def finished_blocks(mixer, blocks):
+    # Overlap-added mixer.render() output through mixer.finish(), in order
+    for block in blocks:
+        with metrics.span("mix"):
+            block = mixer.finish(block)
+        yield block
+
+def prepare_track(duration_sec, style="Lo-Fi Beats", block_size=STREAM_BLOCK, loop_bars=None, variations=0,
+                  seed=None, executor=None, window=4, period_quantum=None):
+    # Everything a render needs before its first sample: the source of mixed
+    # blocks, the style's mixer and a bound on the mixed peak.
+    # All randomness derives from `seed`; None picks a fresh one, reported back
+    # as plan["seed"]. In pattern mode, period_quantum snaps the phrase length
+    # to a multiple of that many samples (see quantize_tempo).
+    seed_seq = np.random.SeedSequence(seed)
+    arrangement_seq, noise_seq = seed_seq.spawn(2)
+    rng = _arrangement_rng(arrangement_seq)
+    settings = get_style_settings(style, rng)
+    total_samples = int(SAMPLE_RATE * duration_sec)
+    mixer = build_mixer(style, settings["use_delay"])
+    period = None
+
+    if loop_bars:
+        # Pattern mode: synthesize and mix 1 + variations phrases once, then
+        # tile the mixed phrases, rings included; only the streamed returns
+        # (the feedback delay) still run over the whole track
+        if period_quantum:
+            settings = quantize_tempo(settings, loop_bars, period_quantum)
+        rendered = [render_phrase(loop_bars, style, settings, rng, segment_rng(noise_seq, i)) for i in range(1 + variations)]
+        phrases = [phrase for phrase, _ in rendered]
+        period = rendered[0][1]
+        with metrics.span("mix"):
+            mixed = [mixer.render(phrase) for phrase in phrases]
+        blocks = finished_blocks(mixer, tiled_blocks(mixed, period, total_samples, block_size))
+        # A phrase overlaps only the tail of the one before it
+        bus_bounds = np.max([np.abs(p).max(axis=1) for p in phrases], axis=0)
+        bus_bounds += np.max([np.abs(p[:, period:]).max(axis=1, initial=0) for p in phrases], axis=0)
+    else:
+        # Compile chords, melody and drums into events up front; rendering and
+        # mixing happen per bar-aligned segment, optionally on a process pool
+        events = compile_arrangement(duration_sec, style, rng, settings)
+        bounds = segment_bounds(total_samples, 240 / settings["bpm"], block_size)
+        blocks = segment_blocks(events, bounds, mixer, noise_seq, executor, window)
+        bus_bounds = [peak_bound(events[events["bus"] == bus]) for bus in range(N_BUSES)]
+        bus_bounds[BUS_CRACKLE] = CRACKLE_AMPLITUDE * NOISE_PEAK
+
+    return {
+        "seed": seed_seq.entropy,
+        "settings": settings,
+        "total_samples": total_samples,
+        "period": period,
+        "blocks": blocks,
+        "mixer": mixer,
+        "peak_bound": mixer.peak_bound(bus_bounds),
+    }
+
+def mix_blocks(plan):
+    # A prepared track's mix, block by block
+    for block in plan["blocks"]:
+        cancellation.check()
+        metrics.count("samples_mixed", len(block))
+        yield block
+
+def stream_lofi_track(duration_sec, style="Lo-Fi Beats", block_size=STREAM_BLOCK, loop_bars=None, variations=0, seed=None):
+    # Yield the unnormalized mix in blocks of roughly block_size samples
+    return mix_blocks(prepare_track(duration_sec, style, block_size, loop_bars, variations, seed))
+
+def limited(blocks, sample_rate=SAMPLE_RATE):
+    # Float mix blocks through the streaming look-ahead limiter
+    return dsp.limit(blocks, LIMIT_CEILING, LIMIT_LOOKAHEAD_SEC * sample_rate, LIMIT_RELEASE_SEC * sample_rate)
+
+def streaming_mix(plan, blocks=None):
+    # The mix (or `blocks`, the same mix from elsewhere) at a fixed gain, block
+    # by block: the gain comes from the first PREROLL_SEC (held back until
+    # measured) and the limiter keeps the rest within full scale
+    blocks = mix_blocks(plan) if blocks is None else iter(blocks)
+    preroll = []
+    held = 0
+    for block in blocks:
+        preroll.append(block)
+        held += len(block)
+        if held >= PREROLL_SEC * SAMPLE_RATE:
+            break
+    loudest = max((dsp.peak(block) for block in preroll), default=0.0)
+    if loudest > 0:
+        gain = LIMIT_CEILING / (loudest * PREROLL_MARGIN)
+    else:
+        gain = LIMIT_CEILING / max(plan["peak_bound"], 1e-9)
+
+    def gained():
+        for block in itertools.chain(preroll, blocks):
+            with metrics.span("normalize"):
+                block = block * gain
+            yield block
+    return limited(gained())
+
+def pcm_blocks(plan, streaming=False):
+    # The prepared track's mix as normalized int16 blocks, ready for a WAV file or
+    # an encoder pipe. Streaming yields block by block in constant memory (see
+    # streaming_mix) and reuses one output buffer, so consume each block before
+    # asking for the next.
+    if streaming:
+        pcm = np.empty(0, dtype="<i2")
+        for block in streaming_mix(plan):
+            if len(block) > len(pcm):
+                pcm = np.empty(len(block), dtype="<i2")
+            with metrics.span("normalize"):
+                block = dsp.to_int16(block, out=pcm[:len(block)])
+            yield block
+        return
+
+    blocks = mix_blocks(plan)
+
+    # Collect the mix so it can be normalized against its true peak
+    track = np.empty(plan["total_samples"], dtype=dsp.DTYPE)
+    pos = 0
+    for block in blocks:
+        track[pos:pos + len(block)] = block
+        pos += len(block)
+
+    # Normalize and convert to int16 in a single pass
+    with metrics.span("normalize"):
+        max_val = dsp.peak(track)
+        pcm = dsp.to_int16(track, 0.95 / max_val if max_val > 0 else 0.0)
+    yield pcm
+
+def normalized_blocks(blocks):
+    # int16 copies of a complete mix kept as blocks, normalized together to the
+    # same true peak as pcm_blocks(plan), sample for sample
+    max_val = max((dsp.peak(block) for block in blocks), default=0.0)
+    gain = 0.95 / max_val if max_val > 0 else 0.0
+    for block in blocks:
+        with metrics.span("normalize"):
+            pcm = dsp.to_int16(block, gain)
+        yield pcm
+
+def write_wav(pcm, output_filename, sample_rate=SAMPLE_RATE):
+    # Write int16 blocks to a mono WAV as they arrive
+    with wave.open(output_filename, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        for block in pcm:
+            with metrics.span("write"):
+                data = block.astype("<i2", copy=False).tobytes()
+                wav.writeframes(data)
+            metrics.count("wav_bytes_written", len(data))
     return output_filename
+
+def write_track(plan, output_filename, streaming=False):
+    return write_wav(pcm_blocks(plan, streaming), output_filename)
+
+def generate_lofi_track(duration_sec, style="Lo-Fi Beats", output_filename="assets/generated/generated_track.wav",
+                        streaming=False, block_size=STREAM_BLOCK, loop_bars=None, variations=0, seed=None, workers=1):
+    # Ensure directory exists
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+
+    # More workers than cores only adds contention
+    workers = min(workers, os.cpu_count() or 1)
+    if workers > 1 and not loop_bars:
+        # Segments render and mix on a process pool; this process overlap-adds
+        # their rings and writes the result
+        with ProcessPoolExecutor(workers) as executor:
+            plan = prepare_track(duration_sec, style, block_size, seed=seed, executor=executor, window=2 * workers)
+            return write_track(plan, output_filename, streaming)
+
+    plan = prepare_track(duration_sec, style, block_size, loop_bars, variations, seed)
+    return write_track(plan, output_filename, streaming)
@@ -0,0 +1,281 @@
+import numpy as np
+from PIL import Image
+
+# Offline procedural backgrounds: NumPy-vectorized layers (gradients, fractal
+# noise, skylines, ridges, stars, rain) composed into one scene per style. Same
+# (style, seed) -> same picture, a 1280x720 frame in a few tens of ms, no network.
+#
+# Images are planar float32 (3, h, w) in [0, 1] while they are composed, so an
+# (h, w) mask broadcasts over the channels without a strided inner loop, and
+# colours are (3, 1, 1).
+
+DTYPE = np.float32
+
+def _rgb(hex_color):
+    return np.array([int(hex_color[i:i + 2], 16) for i in (1, 3, 5)], dtype=DTYPE).reshape(3, 1, 1) / 255
+
+def _jitter(rng, color, amount=0.08):
+    # Small per-seed colour shift so one style's pictures don't all match
+    return np.clip(_rgb(color) * (1 + rng.uniform(-amount, amount, (3, 1, 1)).astype(DTYPE)), 0, 1)
+
+def _smooth(t):
+    return t * t * (3 - 2 * t)
+
+def _resize(grid, h, w, smooth=False):
+    # Separable bilinear (or smoothstep) upsample of a small grid's last two axes to (h, w)
+    def axis(n, size):
+        pos = np.linspace(0, size - 1, n, dtype=DTYPE)
+        i0 = np.minimum(pos.astype(np.intp), size - 2) if size > 1 else np.zeros(n, dtype=np.intp)
+        t = np.clip(pos - i0, 0, 1).astype(DTYPE)
+        return i0, np.minimum(i0 + 1, size - 1), _smooth(t) if smooth else t
+    x0, x1, fx = axis(w, grid.shape[-1])
+    y0, y1, fy = axis(h, grid.shape[-2])
+    rows = grid[..., x0] + (grid[..., x1] - grid[..., x0]) * fx
+    return rows[..., y0, :] + (rows[..., y1, :] - rows[..., y0, :]) * fy[:, None]
+
+def value_noise(rng, h, w, cells=4, octaves=4, persistence=0.5, step=4):
+    # Fractal value noise in [0, 1]: random lattices, smoothly upsampled and
+    # summed at 1/step resolution, then stretched to (h, w) in one pass
+    sh, sw = -(-h // step), -(-w // step)
+    out = np.zeros((sh, sw), dtype=DTYPE)
+    amplitude = total = 1.0
+    for octave in range(octaves):
+        cx = cells << octave
+        cy = max(1, round(cx * h / w))
+        out += amplitude * _resize(rng.random((cy + 1, cx + 1), dtype=DTYPE), sh, sw, smooth=True)
+        total += amplitude
+        amplitude *= persistence
+    return _resize(out / (total - 1), h, w)
+
+def ridge(rng, w, cells=6, octaves=5):
+    # 1D fractal noise in [0, 1], for mountain and hill outlines
+    out = np.zeros(w, dtype=DTYPE)
+    amplitude = total = 1.0
+    x = np.linspace(0, 1, w, dtype=DTYPE)
+    for octave in range(octaves):
+        n = (cells << octave) + 1
+        out += amplitude * np.interp(x, np.linspace(0, 1, n), rng.random(n)).astype(DTYPE)
+        total += amplitude
+        amplitude *= 0.5
+    return out / (total - 1)
+
+def gradient(h, w, stops):
+    # Vertical gradient through (position 0..1, colour) stops
+    y = np.linspace(0, 1, h, dtype=DTYPE)
+    column = np.stack([np.interp(y, [p for p, _ in stops], [c[i, 0, 0] for _, c in stops]) for i in range(3)])
+    return np.repeat(column.astype(DTYPE)[:, :, None], w, axis=2)
+
+def blend(img, mask, color):
+    # img += mask * (color - img), mask shaped (h, w) in [0, 1]
+    step = np.subtract(color, img, dtype=DTYPE)
+    step *= mask
+    img += step
+
+def disc(img, cx, cy, radius, color, glow=0.0, stripes=0):
+    # Anti-aliased disc with an optional soft halo; works on a crop around it
+    _, h, w = img.shape
+    reach = int(radius * (3 if glow else 1.2))
+    y0, y1 = max(0, int(cy) - reach), min(h, int(cy) + reach)
+    x0, x1 = max(0, int(cx) - reach), min(w, int(cx) + reach)
+    if y0 >= y1 or x0 >= x1:
+        return
+    yy = np.arange(y0, y1, dtype=DTYPE)[:, None]
+    xx = np.arange(x0, x1, dtype=DTYPE)[None, :]
+    dist = np.sqrt((yy - cy) ** 2 + (xx - cx) ** 2)
+    crop = img[:, y0:y1, x0:x1]
+    if glow:
+        blend(crop, glow * np.exp(-np.maximum(dist / radius - 1, 0) * 3), color)
+    body = np.clip(radius - dist + 0.5, 0, 1)
+    if stripes:
+        # Synthwave sun: widening gaps across the lower half
+        below = np.clip((yy - cy) / radius, 0, 1)
+        body = body * (((yy - cy) % (radius / stripes)) > below * radius / stripes * 0.6)
+    blend(crop, body, color)
+
+def stars(img, rng, count, max_y=0.6, brightness=1.0):
+    _, h, w = img.shape
+    ys = rng.integers(0, int(h * max_y), count)
+    xs = rng.integers(0, w, count)
+    level = rng.random(count, dtype=DTYPE) ** 3 * brightness
+    img[:, ys, xs] = np.maximum(img[:, ys, xs], level)
+    # The brightest few get a 2x2 core
+    big = level > 0.6 * brightness
+    for dy, dx in [(0, 1), (1, 0), (1, 1)]:
+        y, x = np.minimum(ys[big] + dy, h - 1), np.minimum(xs[big] + dx, w - 1)
+        img[:, y, x] = np.maximum(img[:, y, x], level[big] * 0.7)
+
+def mountains(img, rng, base, height, color, cells=4, haze=None):
+    # Filled ridge line; `haze` fades it towards that colour at the peaks
+    _, h, w = img.shape
+    top = (base - height * ridge(rng, w, cells)) * h
+    start = max(0, int(top.min()))
+    region = img[:, start:]
+    depth = np.arange(start, h, dtype=DTYPE)[:, None] - top[None, :]
+    mask = np.clip(depth, 0, 1)
+    if haze is not None:
+        fade = np.clip(1 - depth / (height * h), 0, 1) * 0.5
+        color = color + (haze - color) * fade
+    blend(region, mask, color)
+
+def skyline(img, rng, base, min_height, max_height, color, window_color=None, lit=0.3, cell=(16, 12)):
+    # Row of buildings standing on y = base (fractions of height), optionally
+    # with a grid of randomly lit windows
+    _, h, w = img.shape
+    widths = rng.integers(max(1, w // 30), max(2, w // 10), w // max(1, w // 30) + 1)
+    heights = rng.uniform(min_height, max_height, len(widths)) * h
+    column = np.repeat(heights, widths)[:w].astype(DTYPE)
+    floor = int(base * h)
+    y = np.arange(floor, dtype=DTYPE)[:, None]
+    mask = y >= floor - column[None, :]
+    region = img[:, :floor]
+    np.copyto(region, color, where=mask)
+    if window_color is not None:
+        ch, cw = cell
+        rows = (np.arange(floor) % ch >= ch // 4) & (np.arange(floor) % ch < ch * 3 // 4)
+        cols = (np.arange(w) % cw >= cw // 4) & (np.arange(w) % cw < cw * 3 // 4)
+        on = rng.random((floor // ch + 1, w // cw + 1)) < lit
+        windows = mask & rows[:, None] & cols[None, :] & on[np.arange(floor) // ch][:, np.arange(w) // cw]
+        # Keep a margin below each roof line
+        windows &= y >= floor - column[None, :] + ch
+        np.copyto(region, window_color, where=windows)
+
+def rain(img, rng, count, length=18, slant=0.25, alpha=0.35, color=(0.75, 0.8, 0.9)):
+    # Straight streaks, drawn by indexing every point of every drop at once
+    _, h, w = img.shape
+    steps = np.arange(length)
+    ys = rng.integers(-length, h, count)[:, None] + steps
+    xs = (rng.integers(0, w, count)[:, None] + steps * slant).astype(np.intp)
+    keep = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+    ys, xs = ys[keep], xs[keep]
+    img[:, ys, xs] += alpha * (np.asarray(color, dtype=DTYPE)[:, None] - img[:, ys, xs])
+
+def perspective_grid(img, horizon, color, spacing=0.06, width=1.2):
+    # Synthwave floor: lines receding to a vanishing point on the horizon. Line
+    # distances are measured in screen pixels so near and far lines stay thin.
+    _, h, w = img.shape
+    top = int(horizon * h)
+    y = np.arange(top + 1, h, dtype=DTYPE)[:, None] - top
+    x = np.arange(w, dtype=DTYPE)[None, :] - w / 2
+    depth = (h - top) / y
+    across = np.abs((x * depth / (w * spacing) + 0.5) % 1 - 0.5) * (w * spacing) / depth
+    along = np.abs((depth * 2 + 0.5) % 1 - 0.5) * y ** 2 / (2 * (h - top))
+    line = np.clip(1 - np.minimum(across, along) / width, 0, 1)
+    fade = np.clip(y / (h - top) * 3, 0, 1)
+    blend(img[:, top + 1:], line * fade, color)
+
+def reflect(img, horizon, rng, tint, strength=0.6):
+    # Water: mirror the scene above the horizon with rippled rows, darkened and tinted
+    _, h, w = img.shape
+    top = int(horizon * h)
+    rows = np.arange(top, h)
+    source = np.clip(2 * top - rows, 0, top - 1)
+    shift = (np.sin(rows * 0.35 + rng.uniform(0, 6)) * (rows - top) / (h - top) * 6).astype(np.intp)
+    cols = (np.arange(w)[None, :] + shift[:, None]) % w
+    mirrored = img[:, source[:, None], cols]
+    img[:, top:] = mirrored * strength + tint * (1 - strength)
+
+def vignette(img, amount=0.35):
+    _, h, w = img.shape
+    vy = 1 - amount * np.linspace(-1, 1, h, dtype=DTYPE) ** 2
+    vx = 1 - amount * np.linspace(-1, 1, w, dtype=DTYPE) ** 2
+    img *= vy[:, None] * vx[None, :]
+
+def grain(img, rng, amount=0.03):
+    noise = rng.random(img.shape[1:], dtype=DTYPE)
+    noise -= 0.5
+    noise *= amount
+    img += noise
+
+# Scenes: each builds a (3, h, w) float image in [0, 1]
+
+def night_city(rng, h, w, rainy=True):
+    img = gradient(h, w, [(0, _jitter(rng, "#1b1640")), (0.6, _jitter(rng, "#4a2c6b")), (1, _jitter(rng, "#ff9a8b"))])
+    stars(img, rng, w // 3, 0.5, 0.8)
+    disc(img, rng.uniform(0.15, 0.85) * w, rng.uniform(0.12, 0.3) * h, h * 0.06, _rgb("#fff4d6"), glow=0.25)
+    skyline(img, rng, 1.0, 0.25, 0.5, _jitter(rng, "#2a1f45"))
+    skyline(img, rng, 1.0, 0.15, 0.4, _jitter(rng, "#120d24"), _jitter(rng, "#ffcf7a"), lit=0.25,
+            cell=(max(4, h // 45), max(3, w // 106)))
+    if rainy:
+        rain(img, rng, w * 2)
+    return img
+
+def sunset_hills(rng, h, w):
+    img = gradient(h, w, [(0, _jitter(rng, "#2e3a6e")), (0.45, _jitter(rng, "#d9768a")), (0.7, _jitter(rng, "#ffc38a"))])
+    disc(img, rng.uniform(0.3, 0.7) * w, 0.58 * h, h * 0.1, _rgb("#ffe8b0"), glow=0.35)
+    haze = _jitter(rng, "#f2a48f")
+    for base, height, color in [(0.72, 0.25, "#6b4a7a"), (0.85, 0.22, "#43305a"), (1.0, 0.2, "#221a33")]:
+        mountains(img, rng, base, height, _jitter(rng, color), cells=3, haze=haze)
+    return img
+
+def nebula(rng, h, w, step=4):
+    # Coloured clouds are shaped and summed at 1/step resolution, then
+    # stretched over the sky in one pass
+    img = gradient(h, w, [(0, _jitter(rng, "#05040f")), (1, _jitter(rng, "#10112a"))])
+    sh, sw = -(-h // step), -(-w // step)
+    clouds = np.zeros((3, sh, sw), dtype=DTYPE)
+    for color in ["#6b3fa0", "#2b7bb9", "#d45d9c"]:
+        cloud = np.clip(value_noise(rng, sh, sw, cells=3, octaves=5, step=1) * 2.2 - 1.0, 0, 1)
+        clouds += cloud * np.sqrt(cloud) * (_jitter(rng, color, 0.2) * 0.8)
+    img += _resize(clouds, h, w)
+    stars(img, rng, w, 1.0, 1.0)
+    return np.clip(img, 0, 1, out=img)
+
+def synthwave(rng, h, w):
+    img = gradient(h, w, [(0, _jitter(rng, "#0b0221")), (0.45, _jitter(rng, "#3d0d5c")), (0.6, _jitter(rng, "#ff2a6d"))])
+    stars(img, rng, w // 4, 0.4, 0.7)
+    disc(img, w / 2, 0.42 * h, h * 0.2, _rgb("#ffd319"), glow=0.2, stripes=7)
+    mountains(img, rng, 0.6, 0.12, _jitter(rng, "#1a0833"), cells=5)
+    img[:, int(0.6 * h):] = _jitter(rng, "#0d0221")
+    perspective_grid(img, 0.6, _jitter(rng, "#ff2ad4"))
+    return img
+
+def jazz_club(rng, h, w):
+    img = gradient(h, w, [(0, _jitter(rng, "#0e0a08")), (0.7, _jitter(rng, "#3b2414")), (1, _jitter(rng, "#8a5a2b"))])
+    # Warm bokeh lights behind the skyline
+    for _ in range(12):
+        disc(img, rng.uniform(0, w), rng.uniform(0.3, 0.8) * h, rng.uniform(0.02, 0.05) * h,
+             _jitter(rng, "#ffb45a", 0.2), glow=0.15)
+    skyline(img, rng, 1.0, 0.2, 0.55, _jitter(rng, "#0a0705"), _jitter(rng, "#f5c26b"), lit=0.35)
+    rain(img, rng, w, alpha=0.25, color=(0.9, 0.75, 0.55))
+    return img
+
+def zen_lake(rng, h, w):
+    img = gradient(h, w, [(0, _jitter(rng, "#a9c6d9")), (0.5, _jitter(rng, "#f4d9c6")), (0.6, _jitter(rng, "#fbe9dc"))])
+    disc(img, rng.uniform(0.25, 0.75) * w, 0.3 * h, h * 0.07, _rgb("#fff6ea"), glow=0.3)
+    haze = _jitter(rng, "#e8e2e8")
+    for base, height, color in [(0.5, 0.22, "#8a9bb0"), (0.6, 0.18, "#5f7187")]:
+        mountains(img, rng, base, height, _jitter(rng, color), cells=3, haze=haze)
+    reflect(img, 0.6, rng, _jitter(rng, "#7f93a8"))
+    return img
+
+def pixel_night(rng, h, w, scale=8):
+    # The night city at 1/scale resolution, posterized and blown up with hard edges
+    small = night_city(rng, -(-h // scale), -(-w // scale), rainy=False)
+    small = np.round(np.clip(small, 0, 1) * 12) / 12
+    return np.repeat(np.repeat(small, scale, axis=1), scale, axis=2)[:, :h, :w].copy()
+
+SCENES = {
+    "Lo-Fi Beats": night_city,
+    "Piano": sunset_hills,
+    "Ambient": nebula,
+    "Synth": synthwave,
+    "Jazz Hop": jazz_club,
+    "Meditation": zen_lake,
+    "8-Bit": pixel_night,
+}
+
+def render_background(music_type, seed, width=1280, height=720):
+    # uint8 (height, width, 3) frame for the style, reproducible from the seed
+    rng = np.random.default_rng(seed)
+    img = SCENES.get(music_type, night_city)(rng, height, width)
+    if music_type != "8-Bit":
+        vignette(img)
+        grain(img, rng)
+    img *= 255
+    img += 0.5
+    np.clip(img, 0, 255, out=img)
+    return np.ascontiguousarray(img.astype(np.uint8).transpose(1, 2, 0))
+
+def generate_background(music_type, seed, output_filename, width=1280, height=720):
+    Image.fromarray(render_background(music_type, seed, width, height)).save(output_filename, quality=92)
+    return output_filename
@@ -0,0 +1,199 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from artifact_cache import DEFAULT_ROOT
+from constants import MUSIC_TYPES
+from jobs import VIDEO_MODES, Job, JobCancelled, run_render, warm_up, worker_context
+from utils import IMAGE_SOURCES
+
+# Headless bulk rendering. A manifest expands to a list of items, each rendered
+# through the same stage graph as the app (audio and image in parallel, then
+# video) on shared pools: a process pool sized to the cores for synthesis and
+# encoding, a thread pool for image fetches. Finished items are recorded in
+# <out_dir>/manifest.json as they complete, so an interrupted batch picks up
+# where it stopped.
+
+MANIFEST_NAME = "manifest.json"
+
+def expand_manifest(manifest):
+    # Items for every style x duration x seed. Without explicit "seeds", "count"
+    # seeds per combination are derived from the manifest's "seed", so the
+    # expansion (and with it every render) is the same on every run.
+    styles = manifest.get("styles") or MUSIC_TYPES
+    durations = manifest.get("durations") or [60]
+    image_source = manifest.get("image_source", "auto")
+    video_mode = manifest.get("video_mode", "still")
+    unknown = [style for style in styles if style not in MUSIC_TYPES]
+    if unknown:
+        raise ValueError(f"Unknown styles {unknown}, expected any of {MUSIC_TYPES}")
+    if image_source not in IMAGE_SOURCES:
+        raise ValueError(f"Unknown image_source {image_source!r}, expected one of {IMAGE_SOURCES}")
+    if video_mode not in VIDEO_MODES:
+        raise ValueError(f"Unknown video_mode {video_mode!r}, expected one of {VIDEO_MODES}")
+
+    explicit = manifest.get("seeds")
+    count = int(manifest.get("count", 1))
+    states = np.random.SeedSequence(manifest.get("seed", 0)).generate_state(count * len(styles) * len(durations))
+    derived = iter(int(state) & 0x7FFFFFFF for state in states)
+
+    items = []
+    for style in styles:
+        for duration in durations:
+            for seed in explicit or [next(derived) for _ in range(count)]:
+                slug = style.lower().replace(" ", "_").replace("-", "")
+                items.append({
+                    # Full duration, so 90.5 and 90.9 get their own ids (60.0 is "60s")
+                    "id": f"{slug}_{duration:.15g}s_{seed}_{video_mode}",
+                    "style": style,
+                    "duration": duration,
+                    "seed": int(seed),
+                    "image_source": image_source,
+                    "video_mode": video_mode,
+                })
+    return items
+
+def _publish(src, dst):
+    # Hard link out of the artifact cache (no copy, and survives eviction);
+    # copy when the output lives on another filesystem
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+class BatchManifest:
+    # The output manifest: one record per item, rewritten atomically after each change
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, MANIFEST_NAME)
+        self.records = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.records = {record["id"]: record for record in json.load(f)["items"]}
+
+    def done(self, item):
+        # Finished earlier with every output still on disk
+        record = self.records.get(item["id"])
+        return bool(record and record["status"] == "done"
+                    and all(os.path.exists(record[k]) for k in ("audio_path", "image_path", "video_path")))
+
+    def update(self, record):
+        with self._lock:
+            self.records[record["id"]] = record
+            directory = os.path.dirname(self.path)
+            fd, tmp_path = tempfile.mkstemp(prefix=".manifest.", dir=directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"updated": time.time(), "items": list(self.records.values())}, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+def render_item(item, out_dir, cpu_pool, io_pool, cache_root, cancelled, manager):
+    # Render one item and publish its files into out_dir; returns its manifest record
+    job = Job({"track_length": item["duration"], "music_type": item["style"], "seed": item["seed"],
+               "image_source": item["image_source"], "video_mode": item["video_mode"]})
+    job.cancelled = cancelled
+    # Set by run_render once the item is cancelled or fails, which stops its
+    # stages still running in worker processes
+    job.cancel_event = manager.Event()
+    start = time.perf_counter()
+    record = dict(item)
+    try:
+        result = run_render(job, cpu_pool, io_pool, cache_root)
+        for key in ("audio_path", "image_path", "video_path"):
+            ext = os.path.splitext(result[key])[1]
+            record[key] = _publish(result[key], os.path.join(out_dir, item["id"] + ext))
+        record["status"] = "done"
+    except JobCancelled:
+        record["status"] = "cancelled"
+    except Exception as e:
+        record.update(status="failed", error=f"Error during {job.stage} stage: {e}")
+
+    # Per-stage wall times, from the job's metrics
+    spans = job.metrics.snapshot()["spans"]
+    record["seconds"] = time.perf_counter() - start
+    record["stages"] = {name[len("stage."):]: entry["seconds"] for name, entry in spans.items() if name.startswith("stage.")}
+    return record
+
+def render_batch(items, out_dir, cpu_workers=None, io_workers=4, cache_root=DEFAULT_ROOT, resume=True, log=print):
+    # Render every item not already done; returns the records of this run
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = BatchManifest(out_dir)
+    todo = [item for item in items if not (resume and manifest.done(item))]
+    if len(todo) < len(items):
+        log(f"Resuming: {len(items) - len(todo)} of {len(items)} items already rendered")
+
+    cpu_workers = cpu_workers or os.cpu_count() or 1
+    # Two items per core: one computing while the next waits on its image. More
+    # would only interleave them, so each finishes (and is recorded) later.
+    in_flight = 2 * cpu_workers
+    cancelled = threading.Event()
+    records = []
+    context = worker_context()
+    manager = (context or multiprocessing).Manager()
+    cpu_pool = ProcessPoolExecutor(cpu_workers, mp_context=context, initializer=warm_up)
+    io_pool = ThreadPoolExecutor(io_workers, thread_name_prefix="batch-io")
+    drivers = ThreadPoolExecutor(in_flight, thread_name_prefix="batch-item")
+    try:
+        pending = set()
+        queue = iter(todo)
+        while True:
+            for item in queue:
+                pending.add(drivers.submit(render_item, item, out_dir, cpu_pool, io_pool, cache_root, cancelled, manager))
+                if len(pending) >= in_flight:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                manifest.update(record)
+                records.append(record)
+                log(f"[{len(records)}/{len(todo)}] {record['id']}: {record['status']} in {record['seconds']:.1f} s"
+                    + (f" ({record['error']})" if record.get("error") else ""))
+    except KeyboardInterrupt:
+        # Let running items stop at their next stage boundary; finished ones are already recorded
+        cancelled.set()
+        log("Interrupted; rerun the same command to resume")
+        raise
+    finally:
+        drivers.shutdown(wait=True, cancel_futures=True)
+        io_pool.shutdown(wait=True, cancel_futures=True)
+        cpu_pool.shutdown(wait=True, cancel_futures=True)
+        manager.shutdown()
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a batch of lofi tracks and videos from a manifest")
+    parser.add_argument("manifest", help='JSON, e.g. {"styles": ["Piano"], "durations": [60, 120], "count": 5, "seed": 1}')
+    parser.add_argument("out_dir")
+    parser.add_argument("--cpu-workers", type=int, help="processes for synthesis and encoding (default: all cores)")
+    parser.add_argument("--io-workers", type=int, default=4, help="threads for image fetches")
+    parser.add_argument("--cache-root", default=DEFAULT_ROOT)
+    parser.add_argument("--no-resume", action="store_true", help="re-render items the output manifest lists as done")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        items = expand_manifest(json.load(f))
+    start = time.perf_counter()
+    try:
+        records = render_batch(items, args.out_dir, args.cpu_workers, args.io_workers, args.cache_root, not args.no_resume)
+    except KeyboardInterrupt:
+        raise SystemExit(130)
+    failed = sum(1 for record in records if record["status"] != "done")
+    print(f"Rendered {len(records) - failed} items in {time.perf_counter() - start:.1f} s, {failed} failed")
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+import argparse
+import ast
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from constants import MUSIC_TYPES, SAMPLE_RATE
+from oscillators import oscillate
+
+def best_of(fn, repeat=5, warmup=True):
+    # Best wall time of `repeat` runs, after one warm-up call unless told otherwise
+    if warmup:
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def legacy_sine(freq, duration, amplitude=0.5):
+    # The per-note np.sin path the wavetable engine replaced
+    t = np.linspace(0, duration, int(SAMPLE_RATE * duration), endpoint=False)
+    return amplitude * np.sin(2 * np.pi * freq * t)
+
+def legacy_square(freq, duration, amplitude=0.5):
+    t = np.linspace(0, duration, int(SAMPLE_RATE * duration), endpoint=False)
+    return amplitude * np.sign(np.sin(2 * np.pi * freq * t))
+
+def bench_oscillators(notes=200, duration=1.0):
+    # Per-note legacy calls vs one batched wavetable read for the same notes
+    freqs = np.random.default_rng(0).uniform(100, 1000, notes)
+    length = int(SAMPLE_RATE * duration)
+    total = notes * length
+    results = []
+    for name, legacy in [("sine", legacy_sine), ("square", legacy_square)]:
+        base = best_of(lambda: [legacy(f, duration) for f in freqs])
+        per_note = best_of(lambda: [oscillate(name, f, length) for f in freqs])
+        batched = best_of(lambda: oscillate(name, freqs, length))
+        results.append({
+            "case": f"oscillators/{name}",
+            "legacy_ns_per_sample": base / total * 1e9,
+            "wavetable_ns_per_sample": per_note / total * 1e9,
+            "batched_ns_per_sample": batched / total * 1e9,
+            "speedup": base / batched,
+        })
+    return results
+
+def cover_image(image_path):
+    # Smooth gradient with a little grain, closer to a real cover than pure noise
+    y, x = np.mgrid[0:720, 0:1280]
+    pixels = np.stack([x / 1280, y / 720, (x + y) / 2000], axis=-1) * 230
+    pixels += np.random.default_rng(0).uniform(0, 25, pixels.shape)
+    Image.fromarray(pixels.astype(np.uint8)).save(image_path)
+    return image_path
+
+def bench_encoder(duration=60, style="Lo-Fi Beats", repeat=2):
+    # Legacy moviepy path (WAV -> MP3, then MP3 + ImageClip -> MP4) vs one ffmpeg
+    # pass fed from NumPy, both starting from the same prepared track
+    from audio_generator import pcm_blocks, prepare_track, write_track
+    from encoder import encode
+    from utils import convert_wav_to_mp3, create_video
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = cover_image(os.path.join(tmp_dir, "cover.jpg"))
+
+        def path(name):
+            return os.path.join(tmp_dir, name)
+
+        def legacy():
+            wav = write_track(prepare_track(duration, style, seed=1), path("legacy.wav"))
+            mp3 = convert_wav_to_mp3(wav, output_path=path("legacy.mp3"))
+            create_video(mp3, image_path, output_path=path("legacy.mp4"))
+
+        def single_pass():
+            plan = prepare_track(duration, style, seed=1)
+            encode(pcm_blocks(plan), path("track.mp3"), path("track.mp4"), image_path, duration=plan["total_samples"] / SAMPLE_RATE)
+
+        synth = best_of(lambda: write_track(prepare_track(duration, style, seed=1), path("synth.wav")), repeat)
+        base = best_of(legacy, repeat)
+        piped = best_of(single_pass, repeat)
+        return [{
+            "case": f"encoder/{style}/{duration}s",
+            "duration_s": float(duration),
+            "synthesis_s": synth,
+            "moviepy_s": base,
+            "single_pass_s": piped,
+            "speedup": base / piped,
+            "mp4_kb": os.path.getsize(path("track.mp4")) / 1024,
+        }]
+
+def bench_visualizer(duration=60, style="Lo-Fi Beats"):
+    # Visualizer video: feature extraction and frame compositing on their own,
+    # then the full render including x264
+    from audio_generator import pcm_blocks, prepare_track
+    from encoder import decode_pcm, encode
+    from visualizer import Visualizer, load_background, render_visualizer, spectrum_features
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = cover_image(os.path.join(tmp_dir, "cover.jpg"))
+        audio_path = encode(pcm_blocks(prepare_track(duration, style, seed=1)), os.path.join(tmp_dir, "track.mp3"))[0]
+        pcm = decode_pcm(audio_path)
+
+        start = time.perf_counter()
+        levels, energy = spectrum_features(pcm)
+        features = time.perf_counter() - start
+
+        visualizer = Visualizer(load_background(image_path))
+        start = time.perf_counter()
+        for _ in visualizer.frames(levels, energy):
+            pass
+        composite = time.perf_counter() - start
+
+        start = time.perf_counter()
+        render_visualizer(audio_path, image_path, os.path.join(tmp_dir, "track.mp4"), style)
+        total = time.perf_counter() - start
+        return [{
+            "case": f"visualizer/{style}/{duration}s",
+            "duration_s": float(duration),
+            "features_s": features,
+            "composite_fps": len(levels) / composite,
+            "render_s": total,
+            "realtime_x": duration / total,
+            "video_fps": len(levels) / total,
+        }]
+
+# Cold start: each target runs in a fresh interpreter under -X importtime.
+# "app" is app.py's own import lines (the script itself needs a Streamlit
+# runtime), "worker" what a fresh pool process imports to unpickle a render
+# stage, and "worker_warm" adds jobs.warm_up(), the rest of the render stack
+# (what the fork server preloads once before forking render workers). A pool
+# can take on work no faster than its workers start.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _app_imports():
+    with open(os.path.join(REPO_DIR, "app.py")) as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+IMPORT_TARGETS = {
+    "app": _app_imports,
+    "worker": lambda: "import jobs",
+    "worker_warm": lambda: "import jobs; jobs.warm_up()",
+}
+
+# Packages listed per target, by total import time
+IMPORT_TOP = 4
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+def import_profile(code):
+    # One fresh interpreter running `code`: (wall seconds, peak RSS in MB,
+    # [(module, self us, cumulative us, depth)] from -X importtime)
+    with tempfile.TemporaryFile() as err:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_DIR,
+                                stdout=subprocess.DEVNULL, stderr=err)
+        # wait4 rather than wait, for this child's own peak RSS
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        err.seek(0)
+        output = err.read().decode()
+    if proc.returncode:
+        raise RuntimeError(f"{code!r} exited with {proc.returncode}:\n{output[-2000:]}")
+    scale = 1 if sys.platform == "darwin" else 1024
+    modules = [(m.group(4), int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2)
+               for m in map(IMPORT_LINE.match, output.splitlines()) if m]
+    return wall, usage.ru_maxrss * scale / 2**20, modules
+
+def bench_imports(repeat=3):
+    results = []
+    for name, code in IMPORT_TARGETS.items():
+        code = code()
+        # The first run may find the interpreter and packages cold on disk
+        cold = import_profile(code)[0]
+        runs = [import_profile(code) for _ in range(repeat)]
+        wall, peak_rss, modules = min(runs, key=lambda run: run[0])
+        by_package = {}
+        for module, self_us, _, _ in modules:
+            package = module.split(".")[0]
+            by_package[package] = by_package.get(package, 0) + self_us
+        heaviest = sorted(by_package.items(), key=lambda item: -item[1])[:IMPORT_TOP]
+        results.append({
+            "case": f"import/{name}",
+            "cold_s": cold,
+            "wall_s": wall,
+            "import_s": sum(cumulative for _, _, cumulative, depth in modules if depth == 0) / 1e6,
+            "modules": len(modules),
+            "peak_rss_mb": peak_rss,
+            "heaviest": ", ".join(f"{package} {us / 1e6:.2f}s" for package, us in heaviest),
+        })
+    return results
+
+# Regression suite: every case runs in a fresh interpreter so peak RSS is its
+# own, is timed cold and then best-of-N warm, then runs once more under
+# tracemalloc for allocation figures (kept out of the timed runs, which it would
+# slow down): the traced peak, and live_blocks, the blocks the run allocated
+# that are still alive at its end (leaks and caches it filled). tracemalloc
+# forgets freed blocks, so that is not a count of every allocation made.
+
+SUITE_DURATIONS = [30, 120, 600]
+
+# Seconds of audio each DSP helper case processes
+DSP_SECONDS = 30
+
+# Track length for the convert/create_video cases
+ENCODE_SECONDS = 60
+
+# A case regresses when its wall time grows by more than this fraction over
+# the baseline, or its peak RSS by more than RSS_THRESHOLD
+TIME_THRESHOLD = 0.15
+RSS_THRESHOLD = 0.25
+
+# Slowdowns smaller than this many seconds are timer noise, whatever the ratio
+MIN_TIME_DELTA = 0.01
+
+def _track_case(style, duration):
+    from audio_generator import generate_lofi_track
+
+    def setup(tmp_dir):
+        output = os.path.join(tmp_dir, "track.wav")
+        return lambda: generate_lofi_track(duration, style, output, seed=1)
+    return duration, setup
+
+def _dsp_case(name):
+    import audio_generator
+
+    def setup(tmp_dir):
+        if name == "generate_sine_wave":
+            return lambda: audio_generator.generate_sine_wave(440.0, DSP_SECONDS)
+        wave = audio_generator.generate_sine_wave(440.0, DSP_SECONDS)
+        fn = getattr(audio_generator, name)
+        return lambda: fn(wave)
+    return DSP_SECONDS, setup
+
+def _encode_case(name):
+    from audio_generator import prepare_track, write_track
+    from utils import convert_wav_to_mp3, create_video
+
+    def setup(tmp_dir):
+        wav = write_track(prepare_track(ENCODE_SECONDS, seed=1), os.path.join(tmp_dir, "track.wav"))
+        mp3 = os.path.join(tmp_dir, "track.mp3")
+        if name == "convert_wav_to_mp3":
+            return lambda: convert_wav_to_mp3(wav, mp3)
+        convert_wav_to_mp3(wav, mp3)
+        image = cover_image(os.path.join(tmp_dir, "cover.jpg"))
+        return lambda: create_video(mp3, image, os.path.join(tmp_dir, "track.mp4"))
+    return ENCODE_SECONDS, setup
+
+def suite_cases(durations=SUITE_DURATIONS, styles=MUSIC_TYPES):
+    # name -> (seconds of audio, setup(tmp_dir) -> callable to time)
+    cases = {}
+    for style in styles:
+        for duration in durations:
+            cases[f"track/{style}/{duration}s"] = _track_case(style, duration)
+    for name in ["generate_sine_wave", "envelope", "apply_delay"]:
+        cases[f"dsp/{name}"] = _dsp_case(name)
+    for name in ["convert_wav_to_mp3", "create_video"]:
+        cases[f"encode/{name}"] = _encode_case(name)
+    return cases
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+def run_case(name, durations, styles, repeat):
+    # Runs in its own worker process
+    seconds, setup = suite_cases(durations, styles)[name]
+    # moviepy's progress bars would bury the report
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        fn = setup(tmp_dir)
+        rss_before = _peak_rss_mb()
+        # The first run pays for cold caches (voices, wavetables), so it is reported on its own
+        start = time.perf_counter()
+        fn()
+        cold = time.perf_counter() - start
+        wall = best_of(fn, repeat, warmup=False) if repeat else cold
+        peak_rss = _peak_rss_mb()
+
+        tracemalloc.start()
+        fn()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        tracemalloc.stop()
+        live_blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+
+    return {
+        "case": name,
+        "audio_s": float(seconds),
+        "cold_s": cold,
+        "wall_s": wall,
+        "realtime_x": seconds / wall,
+        "peak_rss_mb": peak_rss,
+        "rss_growth_mb": peak_rss - rss_before,
+        "alloc_peak_mb": traced_peak / 2**20,
+        "live_blocks": live_blocks,
+    }
+
+def bench_suite(durations=SUITE_DURATIONS, styles=MUSIC_TYPES, repeat=3):
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for name in suite_cases(durations, styles):
+        # Long renders are only timed cold
+        runs = 0 if name.startswith("track/") and name.endswith(f"/{max(durations)}s") else repeat
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            results.append(pool.submit(run_case, name, durations, styles, runs).result())
+        print(f"{name:<36} {results[-1]['wall_s']:8.3f} s  {results[-1]['realtime_x']:8.1f}x", file=sys.stderr)
+    return results
+
+def compare(results, baseline, time_threshold=TIME_THRESHOLD, rss_threshold=RSS_THRESHOLD):
+    # Annotate rows with their ratio to the baseline's matching case; returns
+    # the names of the cases that regressed. Cases new since the baseline are skipped.
+    previous = {row["case"]: row for row in baseline["results"]}
+    regressions = []
+    for row in results:
+        base = previous.get(row["case"])
+        if base is None:
+            continue
+        row["time_ratio"] = row["wall_s"] / base["wall_s"]
+        row["rss_ratio"] = row["peak_rss_mb"] / base["peak_rss_mb"]
+        slower = row["time_ratio"] > 1 + time_threshold and row["wall_s"] - base["wall_s"] > MIN_TIME_DELTA
+        if slower or row["rss_ratio"] > 1 + rss_threshold:
+            regressions.append(row["case"])
+    return regressions
+
+def environment():
+    import numpy
+    return {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+def print_table(rows):
+    keys = list(rows[0])
+    print("  ".join(f"{k:>24}" for k in keys))
+    for row in rows:
+        print("  ".join(f"{v:>24.2f}" if isinstance(v, float) else f"{v:>24}" for v in row.values()))
+
+BENCHMARKS = {
+    "oscillators": bench_oscillators,
+    "encoder": bench_encoder,
+    "visualizer": bench_visualizer,
+    "imports": bench_imports,
+    "suite": bench_suite,
+}
+
+# Benchmarks whose rows carry the wall_s and peak_rss_mb that compare() checks
+COMPARABLE = ["imports", "suite"]
+
+def main():
+    parser = argparse.ArgumentParser(description="LoFi Studio performance benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), nargs="?", default="oscillators")
+    parser.add_argument("--json", help="write the results here as JSON")
+    parser.add_argument("--baseline", help="JSON from an earlier run to compare against; exits 1 on a regression")
+    parser.add_argument("--time-threshold", type=float, default=TIME_THRESHOLD)
+    parser.add_argument("--rss-threshold", type=float, default=RSS_THRESHOLD)
+    parser.add_argument("--durations", type=int, nargs="+", default=SUITE_DURATIONS, help="suite track lengths")
+    parser.add_argument("--styles", nargs="+", choices=MUSIC_TYPES, default=MUSIC_TYPES, help="suite styles")
+    parser.add_argument("--repeat", type=int, default=3, help="warm runs per suite case or import target")
+    args = parser.parse_args()
+    if args.baseline and args.benchmark not in COMPARABLE:
+        parser.error(f"--baseline only applies to {', '.join(COMPARABLE)}")
+
+    if args.benchmark == "suite":
+        rows = bench_suite(args.durations, args.styles, args.repeat)
+    elif args.benchmark == "imports":
+        rows = bench_imports(args.repeat)
+    else:
+        rows = BENCHMARKS[args.benchmark]()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(rows, json.load(f), args.time_threshold, args.rss_threshold)
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": args.benchmark, "environment": environment(), "results": rows}, f, indent=2)
+    if regressions:
+        print(f"Regressed beyond threshold: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
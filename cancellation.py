@@ -0,0 +1,49 @@
+import contextlib
+import contextvars
+import time
+
+# Cooperative cancellation for work that can't simply be dropped, such as a
+# render stage already running in a worker process. The caller hands in an
+# event (anything with is_set(), e.g. a multiprocessing.Manager().Event(),
+# which pickles across to the worker); long loops call check() between
+# blocks, which raises Cancelled once the event is set. Outside watch() it
+# does nothing.
+
+# Seconds between looks at the event: a manager event is a round trip to
+# another process, too slow to ask on every block
+CHECK_INTERVAL = 0.1
+
+_active = contextvars.ContextVar("cancellation", default=None)
+
+class Cancelled(Exception):
+    pass
+
+class _Watch:
+    def __init__(self, event):
+        self.event = event
+        self.next_check = 0.0
+
+@contextlib.contextmanager
+def watch(event):
+    # Make check() in this context raise once `event` is set
+    token = _active.set(_Watch(event) if event is not None else None)
+    try:
+        yield
+    finally:
+        _active.reset(token)
+
+def check():
+    watched = _active.get()
+    if watched is None:
+        return
+    now = time.monotonic()
+    if now < watched.next_check:
+        return
+    watched.next_check = now + CHECK_INTERVAL
+    if watched.event.is_set():
+        raise Cancelled()
+
+def run_watched(event, fn, *args):
+    # fn(*args) under watch(event). Top level so process pools can pickle it.
+    with watch(event):
+        return fn(*args)
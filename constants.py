@@ -57,3 +57,7 @@ STYLE_MODIFIERS = [
     "digital art",
     "artstation"
 ]
+
+# Bump whenever the same (style, duration, seed) would render different audio,
+# so cached artifacts from older engines are not reused
+ENGINE_VERSION = 2
@@ -0,0 +1,138 @@
+from functools import lru_cache
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# float32 DSP core. Everything here works in place on caller-owned buffers (or
+# writes into an `out=` target); the only temporaries are ramp tables and
+# fixed-size scratch blocks, never full-length copies.
+
+DTYPE = np.float32
+
+# Scratch block for chunked passes over long buffers
+CHUNK = 1 << 16
+
+@lru_cache(maxsize=256)
+def _ramp(length, rising):
+    ramp = np.linspace(0, 1, length, dtype=DTYPE) if rising else np.linspace(1, 0, length, dtype=DTYPE)
+    ramp.setflags(write=False)
+    return ramp
+
+def envelope(wave, attack_samples, release_samples, out=None):
+    # Linear attack/release along the last axis; both are capped at half the length
+    if out is None:
+        out = wave
+    elif out is not wave:
+        np.copyto(out, wave)
+    length = out.shape[-1]
+    attack_samples = min(int(attack_samples), length // 2)
+    release_samples = min(int(release_samples), length // 2)
+    if attack_samples > 0:
+        out[..., :attack_samples] *= _ramp(attack_samples, True)
+    if release_samples > 0:
+        out[..., length - release_samples:] *= _ramp(release_samples, False)
+    return out
+
+def apply_delay(wave, delay_samples, decay, out=None):
+    # Single-tap echo truncated to the input length: out[n] = x[n] + decay * x[n - d].
+    # Works back to front in d-sized steps so every read still sees the dry signal.
+    if out is None:
+        out = wave
+    elif out is not wave:
+        np.copyto(out, wave)
+    length = out.shape[-1]
+    delay_samples = int(delay_samples)
+    if not 0 < delay_samples < length:
+        return out
+    scratch = np.empty(out.shape[:-1] + (min(delay_samples, length - delay_samples),), dtype=out.dtype)
+    end = length
+    while end > delay_samples:
+        start = max(delay_samples, end - delay_samples)
+        tap = scratch[..., :end - start]
+        np.multiply(out[..., start - delay_samples:end - delay_samples], decay, out=tap)
+        out[..., start:end] += tap
+        end = start
+    return out
+
+def apply_gain(buf, gain):
+    buf *= gain
+    return buf
+
+def mix_into(track, wave, start):
+    # Add wave into track at sample `start` (along the last axis), dropping
+    # whatever falls outside
+    lo = max(0, -start)
+    hi = min(wave.shape[-1], track.shape[-1] - start)
+    if hi > lo:
+        track[..., start + lo:start + hi] += wave[..., lo:hi]
+    return track
+
+def add_noise(buf, amplitude, rng):
+    # Gaussian noise added in CHUNK-sized pieces through one small scratch buffer
+    scratch = np.empty(min(CHUNK, len(buf)), dtype=DTYPE)
+    for start in range(0, len(buf), CHUNK):
+        piece = scratch[:min(CHUNK, len(buf) - start)]
+        rng.standard_normal(dtype=DTYPE, out=piece)
+        piece *= amplitude
+        buf[start:start + len(piece)] += piece
+    return buf
+
+def peak(buf):
+    # max(|buf|) without materializing np.abs(buf)
+    if len(buf) == 0:
+        return 0.0
+    return float(max(buf.max(), -buf.min()))
+
+def to_int16(buf, gain=1.0, out=None):
+    # Scale, clip and truncate to int16 in one chunked pass; buf is left untouched
+    if out is None:
+        out = np.empty(len(buf), dtype=np.int16)
+    scratch = np.empty(min(CHUNK, len(buf)), dtype=DTYPE)
+    scale = gain * 32767
+    for start in range(0, len(buf), CHUNK):
+        piece = scratch[:min(CHUNK, len(buf) - start)]
+        np.multiply(buf[start:start + len(piece)], scale, out=piece)
+        np.clip(piece, -32767, 32767, out=piece)
+        np.copyto(out[start:start + len(piece)], piece, casting="unsafe")
+    return out
+
+def limit(blocks, ceiling, lookahead, release):
+    # Look-ahead peak limiter over a stream of float blocks: yields the same
+    # blocks, one behind, with |x| <= ceiling. Gain ramps down over `lookahead`
+    # samples before a peak (a moving average of the minimum needed gain over
+    # the next 2 * lookahead, so it is reached by the peak) and recovers with an
+    # exponential `release` (in samples). Blocks that need nothing pass through as is.
+    lookahead = max(1, int(lookahead))
+    log_r = -1.0 / release
+    history = np.ones(lookahead - 1)
+    reduction = 0.0
+    held = None
+    for block in blocks:
+        if held is not None:
+            out, history, reduction = _limit_block(held, block[:2 * lookahead], ceiling, lookahead, log_r,
+                                                  history, reduction)
+            yield out
+        held = block
+    if held is not None:
+        yield _limit_block(held, held[:0], ceiling, lookahead, log_r, history, reduction)[0]
+
+def _limit_block(x, ahead, ceiling, lookahead, log_r, history, reduction):
+    # One limit() step: (output, gain history, gain reduction at its end)
+    n = len(x)
+    if reduction < 1e-4 and history.min() == 1 and peak(x) <= ceiling and peak(ahead) <= ceiling:
+        return x, history, 0.0
+    level = np.abs(np.concatenate((x, ahead))).astype(np.float64)
+    needed = np.ones(n + 2 * lookahead)
+    np.divide(ceiling, level, out=needed[:len(level)], where=level > ceiling)
+    # Minimum over the next 2 * lookahead samples, then a moving average over lookahead
+    lowest = np.concatenate((history, sliding_window_view(needed, 2 * lookahead + 1).min(axis=1)))
+    sums = np.concatenate(([0.0], np.cumsum(lowest)))
+    attack = (sums[lookahead:] - sums[:-lookahead]) / lookahead
+    # Release: reduction[i] = max(1 - attack[i], r * reduction[i - 1]), solved
+    # in the log domain as one running maximum
+    steps = np.arange(n) * log_r
+    log_needed = np.log(np.maximum(1 - attack, 1e-12)) - steps
+    start = np.log(max(reduction, 1e-12)) + log_r
+    env = np.exp(steps + np.maximum.accumulate(np.maximum(log_needed, start)))
+    out = (x * (1 - env)).astype(x.dtype)
+    return out, lowest[len(lowest) - lookahead + 1:] if lookahead > 1 else history, float(env[-1])
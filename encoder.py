@@ -0,0 +1,169 @@
+import os
+import subprocess
+import tempfile
+
+import imageio_ffmpeg
+import numpy as np
+
+import cancellation
+import metrics
+from constants import SAMPLE_RATE
+
+# Single-process ffmpeg encoding fed straight from NumPy. int16 PCM blocks are
+# written to ffmpeg's stdin, so no WAV is ever written or read back, and one
+# invocation can emit the MP3 and the still-image MP4 side by side.
+
+MP3_BITRATE = "192k"
+# Bytes per second of a finished or partly written MP3, at the CBR bitrate above
+MP3_BYTES_PER_SEC = int(MP3_BITRATE.rstrip("k")) * 1000 // 8
+
+# Draft previews: half the sample rate, a third of the bitrate
+DRAFT_SAMPLE_RATE = 22050
+DRAFT_BITRATE = "64k"
+# Plenty for mono; ffmpeg's AAC encoder gets ~3x slower above this
+AAC_BITRATE = "128k"
+# MP4 audio. The fast coder takes about half the default's time.
+AAC_ARGS = ["-c:a", "aac", "-b:a", AAC_BITRATE, "-aac_coder", "fast"]
+
+# Largest single write to ffmpeg's stdin, so a whole-track block still looks
+# for a cancel every second or so of encoding
+PIPE_WRITE_BYTES = 1 << 20
+
+# A still image needs one frame per second and a single keyframe; every other
+# frame is an empty P-frame, so video cost is close to zero
+STILL_FPS = 1
+STILL_GOP = 1 << 16
+
+STILL_VIDEO_ARGS = [
+    "-c:v", "libx264", "-tune", "stillimage", "-preset", "veryfast",
+    "-r", str(STILL_FPS), "-g", str(STILL_GOP), "-pix_fmt", "yuv420p",
+    # x264 needs even dimensions
+    "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+    "-shortest", "-movflags", "+faststart",
+]
+
+def ffmpeg_exe():
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def warm_up_ffmpeg():
+    # Locate ffmpeg and run it once, so the first real encode pays neither the
+    # lookup nor paging the binary in
+    subprocess.run([ffmpeg_exe(), "-hide_banner", "-version"], capture_output=True, check=True)
+
+def pcm_input(sample_rate=SAMPLE_RATE):
+    # Raw mono int16 on stdin
+    return ["-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0"]
+
+def still_input(image_path):
+    return ["-loop", "1", "-framerate", str(STILL_FPS), "-i", image_path]
+
+def run_ffmpeg(args, chunks=None):
+    # Run ffmpeg with `args`, streaming `chunks` (arrays or bytes, written as
+    # is) to its stdin. stderr goes to a temp file so a chatty encoder can
+    # never stall the pipe. ffmpeg is killed if the stage is cancelled.
+    with tempfile.TemporaryFile() as log:
+        proc = subprocess.Popen(
+            [ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-y", *args],
+            stdin=subprocess.PIPE if chunks is not None else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+        try:
+            if chunks is not None:
+                try:
+                    for chunk in chunks:
+                        data = memoryview(chunk).cast("B")
+                        for start in range(0, data.nbytes, PIPE_WRITE_BYTES):
+                            cancellation.check()
+                            # A full pipe blocks here while ffmpeg encodes, so this is encode time
+                            with metrics.span("encode"):
+                                proc.stdin.write(data[start:start + PIPE_WRITE_BYTES])
+                        metrics.count("bytes_encoded", data.nbytes)
+                finally:
+                    proc.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg quit early; its exit code and log say why
+            pass
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        with metrics.span("encode"):
+            code = wait_cancellable(proc)
+        if code != 0:
+            log.seek(0)
+            raise RuntimeError(f"ffmpeg exited with {code}: {log.read().decode(errors='replace').strip()[-2000:]}")
+
+def wait_cancellable(proc):
+    # proc.wait(), killing it if the stage is cancelled meanwhile
+    while True:
+        try:
+            return proc.wait(timeout=cancellation.CHECK_INTERVAL)
+        except subprocess.TimeoutExpired:
+            pass
+        try:
+            cancellation.check()
+        except cancellation.Cancelled:
+            proc.kill()
+            proc.wait()
+            raise
+
+def int16_chunks(pcm):
+    return (block.astype("<i2", copy=False) for block in pcm)
+
+def decode_pcm(audio_path, sample_rate=SAMPLE_RATE):
+    # Whole file as mono int16 at sample_rate
+    result = subprocess.run([ffmpeg_exe(), "-v", "error", "-i", audio_path, "-f", "s16le", "-ac", "1",
+                             "-ar", str(sample_rate), "pipe:1"], capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode {audio_path}: {result.stderr.decode(errors='replace').strip()[-2000:]}")
+    return np.frombuffer(result.stdout, dtype="<i2")
+
+def encode(pcm, mp3_path=None, mp4_path=None, image_path=None, duration=None, sample_rate=SAMPLE_RATE):
+    # Encode int16 blocks to an MP3 and/or a still-image MP4 in one ffmpeg pass.
+    # Passing the track duration pins the MP4's length; -shortest alone can let
+    # the looping image run a few seconds past the end of piped audio.
+    if not mp3_path and not mp4_path:
+        raise ValueError("Nothing to encode: pass mp3_path and/or mp4_path")
+    if mp4_path and not image_path:
+        raise ValueError("An MP4 needs an image_path")
+
+    args = pcm_input(sample_rate)
+    if mp4_path:
+        args += still_input(image_path)
+    if mp3_path:
+        os.makedirs(os.path.dirname(mp3_path) or ".", exist_ok=True)
+        args += ["-map", "0:a", "-c:a", "libmp3lame", "-b:a", MP3_BITRATE, mp3_path]
+    if mp4_path:
+        os.makedirs(os.path.dirname(mp4_path) or ".", exist_ok=True)
+        args += ["-map", "1:v", "-map", "0:a", *STILL_VIDEO_ARGS, *AAC_ARGS]
+        if duration:
+            args += ["-t", f"{duration:.3f}"]
+        args.append(mp4_path)
+    run_ffmpeg(args, int16_chunks(pcm))
+    return mp3_path, mp4_path
+
+def encode_draft(pcm, mp3_path, sample_rate=SAMPLE_RATE):
+    # Small, fast MP3 for previews, resampled to DRAFT_SAMPLE_RATE on the way in
+    os.makedirs(os.path.dirname(mp3_path) or ".", exist_ok=True)
+    run_ffmpeg(pcm_input(sample_rate) + ["-ar", str(DRAFT_SAMPLE_RATE), "-c:a", "libmp3lame", "-b:a", DRAFT_BITRATE,
+                                         mp3_path], int16_chunks(pcm))
+    return mp3_path
+
+def mux_still(audio_path, image_path, mp4_path, duration=None):
+    # Still-image MP4 around an already encoded track, for when the MP3 exists
+    # before the image does (see jobs.render_video). The MP3 is transcoded to
+    # AAC: MP3 in MP4 is not played everywhere. As in encode(), pass the
+    # duration: with the audio re-encoded, -shortest overshoots by many seconds.
+    os.makedirs(os.path.dirname(mp4_path) or ".", exist_ok=True)
+    args = ["-i", audio_path, *still_input(image_path), "-map", "1:v", "-map", "0:a", *STILL_VIDEO_ARGS, *AAC_ARGS]
+    if duration:
+        args += ["-t", f"{duration:.3f}"]
+    run_ffmpeg(args + [mp4_path])
+    return mp4_path
+
+def still_video(image_path, mp4_path, duration):
+    # Silent still-image MP4 of the given length, e.g. to be looped under longer audio
+    os.makedirs(os.path.dirname(mp4_path) or ".", exist_ok=True)
+    run_ffmpeg([*still_input(image_path), "-t", f"{duration:.3f}", *STILL_VIDEO_ARGS, "-an", mp4_path])
+    return mp4_path
@@ -0,0 +1,436 @@
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import numpy as np
+
+import cancellation
+import dsp
+import metrics
+from artifact_cache import ArtifactCache, artifact_key, DEFAULT_ROOT
+from audio_generator import SAMPLE_RATE, mix_blocks, normalized_blocks, pcm_blocks, prepare_track, streaming_mix
+from constants import ENGINE_VERSION
+from encoder import MP3_BYTES_PER_SEC, encode, encode_draft, mux_still, warm_up_ffmpeg
+from utils import get_background
+from visualizer import render_visualizer
+
+# Background render jobs. A bounded thread pool drives each job's stage graph,
+# CPU-heavy stages (synthesis + MP3, video mux) go to a shared process pool,
+# network-bound ones to an I/O thread pool, and the UI polls status() instead of
+# blocking its script run. Every stage runs under its own metrics recorder; the
+# job collects them, and the manager keeps running totals for export.
+
+# Render pipeline as a dependency graph: (stage, depends on, share of the
+# progress bar, message). Stages whose dependencies are met run concurrently,
+# so wall time is about max(audio, image) + video rather than the sum.
+PIPELINE = [
+    ("audio", (), 50, "🎹 Composing melody..."),
+    ("image", (), 10, "🎨 Painting the scene..."),
+    ("video", ("audio", "image"), 40, "🎬 Rendering video final cut..."),
+]
+
+# Seconds between cancellation checks while waiting on stages
+CANCEL_POLL = 0.2
+
+# Length of a draft preview, and the fade that closes it
+PREVIEW_SEC = 15
+PREVIEW_FADE_SEC = 1.5
+
+# Prometheus text file with the running totals of every job; unset disables it
+METRICS_FILE = os.environ.get("LOFI_METRICS_FILE")
+
+# "still" muxes the background under the audio; "visualizer" renders
+# audio-reactive spectrum bars over it
+VIDEO_MODES = ["still", "visualizer"]
+
+# What the render stack imports lazily (SciPy, for the mixer and the visualizer)
+RENDER_MODULES = ["scipy.fft", "scipy.signal"]
+
+def warm_up():
+    # Load RENDER_MODULES and start ffmpeg once. Process pools run it in each
+    # worker as it starts; the app runs it in the background after its first paint.
+    for name in RENDER_MODULES:
+        importlib.import_module(name)
+    warm_up_ffmpeg()
+
+def worker_context():
+    # Render workers fork from a single-threaded fork server rather than from
+    # this process: forking here, while another thread is halfway through a
+    # lazy import, leaves the child waiting forever on that import's lock. The
+    # server preloads the render stack once, so every worker it forks starts
+    # warm. None (the platform default) where there is no fork server.
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["jobs"] + RENDER_MODULES)
+    return context
+
+class QueueFull(Exception):
+    pass
+
+class JobCancelled(Exception):
+    pass
+
+def render_mp3(track_length, music_type, seed, output_path, partial_path=None):
+    # Synthesize and pipe the PCM straight into the MP3 encoder, no WAV in between.
+    # With partial_path, a draft streams there as the mix renders (streaming
+    # gain), so it is playable from the first seconds on; the finished file is
+    # then encoded from the kept mix at its true peak, the same file a regular
+    # render makes.
+    plan = prepare_track(track_length, music_type, seed=seed)
+    if partial_path is None:
+        return encode(pcm_blocks(plan), mp3_path=output_path)[0]
+
+    mix = []
+    def kept():
+        for block in mix_blocks(plan):
+            mix.append(block)
+            yield block
+    encode((dsp.to_int16(block) for block in streaming_mix(plan, kept())), mp3_path=partial_path)
+    return encode(normalized_blocks(mix), mp3_path=output_path)[0]
+
+def render_preview(track_length, music_type, seed, output_path, preview_sec=PREVIEW_SEC):
+    # Draft of the opening of the track this seed renders in full: only the
+    # excerpt is synthesized (plans are lazy) and it is encoded small. Levels
+    # match a progressive render's draft. It is synthesized at SAMPLE_RATE and
+    # only the encoder drops to DRAFT_SAMPLE_RATE: the voice and wavetable
+    # caches are built for one rate, and synthesis is ~0.15 s of a warm call.
+    # A cold one mostly waits on importing SciPy, which warm_up() moves off
+    # the click. The pre-roll (PREROLL_SEC) fits inside the excerpt.
+    plan = prepare_track(track_length, music_type, seed=seed)
+    n = min(plan["total_samples"], int(preview_sec * SAMPLE_RATE))
+    excerpt = np.empty(n, dtype=dsp.DTYPE)
+    pos = 0
+    for block in streaming_mix(plan):
+        take = min(len(block), n - pos)
+        excerpt[pos:pos + take] = block[:take]
+        pos += take
+        if pos == n:
+            break
+    fade = min(n, int(PREVIEW_FADE_SEC * SAMPLE_RATE))
+    excerpt[n - fade:] *= np.linspace(1, 0, fade, dtype=dsp.DTYPE)
+    return encode_draft([dsp.to_int16(excerpt)], output_path)
+
+# Everything is cached by a hash of its inputs, so repeat requests (or a new
+# image over the same audio) only redo what changed. Cached files are named by
+# their keys, so the video is keyed by the file names of its inputs.
+
+def audio_key(track_length, music_type, seed):
+    return artifact_key("audio", style=music_type, duration=track_length, seed=seed, engine=ENGINE_VERSION)
+
+def preview_key(track_length, music_type, seed, preview_sec=PREVIEW_SEC):
+    return artifact_key("preview", style=music_type, duration=track_length, seed=seed, length=preview_sec,
+                        engine=ENGINE_VERSION)
+
+def video_key(audio_path, image_path, video_mode="still", music_type=None):
+    # MP4s cached before the audio was transcoded to AAC hold the MP3 stream
+    params = {"audio": os.path.basename(audio_path), "image": os.path.basename(image_path), "engine": ENGINE_VERSION,
+              "audio_codec": "aac"}
+    if video_mode != "still":
+        # Bar colours follow the style
+        params.update(mode=video_mode, style=music_type)
+    return artifact_key("video", **params)
+
+# Stage builders are top level so the process pool can pickle them
+
+def build_audio(track_length, music_type, seed, cache_root=DEFAULT_ROOT, progressive=False):
+    # Progressive builds also write a draft to the cache's partial path, where
+    # Job.snapshot() finds how much is playable; the artifact is the same either way
+    cache = ArtifactCache(cache_root)
+    key = audio_key(track_length, music_type, seed)
+    if progressive:
+        return cache.get_or_create(key, ".mp3", lambda path, partial_path: render_mp3(
+            track_length, music_type, seed, path, partial_path), partial=True)
+    return cache.get_or_create(key, ".mp3", lambda path: render_mp3(track_length, music_type, seed, path))
+
+def build_preview(track_length, music_type, seed, cache_root=DEFAULT_ROOT, preview_sec=PREVIEW_SEC):
+    return ArtifactCache(cache_root).get_or_create(
+        preview_key(track_length, music_type, seed, preview_sec), ".mp3",
+        lambda path: render_preview(track_length, music_type, seed, path, preview_sec))
+
+def render_video(audio_path, image_path, output_path, video_mode="still", music_type=None, duration=None):
+    # A pass of its own over the finished MP3, though encode() could write the
+    # still MP4 alongside it: the image stage runs next to audio synthesis and
+    # may not be done (remote backgrounds) by the time encoding starts, and a
+    # new image or video mode over a cached track then skips synthesis.
+    if video_mode == "visualizer":
+        return render_visualizer(audio_path, image_path, output_path, music_type)
+    if video_mode != "still":
+        raise ValueError(f"Unknown video mode {video_mode!r}, expected one of {VIDEO_MODES}")
+    return mux_still(audio_path, image_path, output_path, duration)
+
+def build_video(audio_path, image_path, cache_root=DEFAULT_ROOT, video_mode="still", music_type=None, duration=None):
+    return ArtifactCache(cache_root).get_or_create(
+        video_key(audio_path, image_path, video_mode, music_type), ".mp4",
+        lambda path: render_video(audio_path, image_path, path, video_mode, music_type, duration))
+
+class Job:
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = "queued"
+        self.stage = None
+        self.stages = {name: "pending" for name, _, _, _ in PIPELINE}
+        self.progress = 0
+        self.message = "Waiting for a free studio..."
+        self.events = []
+        self.metrics = metrics.Metrics()
+        # Growing MP3 of a progressive render, while its audio stage runs
+        self.partial_path = None
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.created = time.time()
+        self.finished = None
+        self.cancelled = threading.Event()
+        # Set along with `cancelled` for the stages already running in worker
+        # processes, which poll it between blocks; a manager event, so it pickles
+        self.cancel_event = None
+        # Stages that were still running when the job ended
+        self.orphans = []
+        self._lock = threading.Lock()
+
+    def report(self, stage, progress, message, state="running"):
+        # Progress event from the job's own thread; raises if the job was cancelled
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        with self._lock:
+            self.stage = stage
+            self.progress = progress
+            self.message = message
+            if stage in self.stages:
+                self.stages[stage] = state
+            self.events.append({"time": time.time(), "stage": stage, "state": state, "progress": progress, "message": message})
+
+    def fail(self, stage):
+        # Mark the stage that broke the job, without the cancellation check
+        with self._lock:
+            self.stage = stage
+            self.stages[stage] = "failed"
+
+    def close(self, status, result=None, error=None):
+        with self._lock:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+
+    def playable(self):
+        # Seconds of the progressive MP3 written so far, or None
+        if not self.partial_path or self.stages.get("audio") != "running":
+            return None
+        try:
+            return os.path.getsize(self.partial_path) / MP3_BYTES_PER_SEC
+        except OSError:
+            return None
+
+    def snapshot(self):
+        playable = self.playable()
+        with self._lock:
+            return {
+                "id": self.id,
+                "params": dict(self.params),
+                "status": self.status,
+                "stage": self.stage,
+                "stages": dict(self.stages),
+                "progress": self.progress,
+                "message": self.message,
+                "events": list(self.events),
+                "metrics": self.metrics.snapshot(),
+                "partial_path": self.partial_path if playable else None,
+                "playable_s": playable,
+                "result": self.result,
+                "error": self.error,
+                "traceback": self.traceback,
+            }
+
+def _running_message(running, starting=None):
+    stages = list(running.values()) + ([starting] if starting else [])
+    return "  ".join(stage[3] for stage in stages)
+
+def run_pipeline(job, start_stage, pipeline=PIPELINE):
+    # Start every stage whose dependencies have finished and report each one as
+    # it completes. start_stage(name, results) returns a Future of (result,
+    # metrics snapshot), e.g. from metrics.run_instrumented. The first failure
+    # (or a cancel) drops the stages that have not started yet and sets
+    # job.cancel_event for those already running, which stay in job.orphans
+    # until they stop.
+    results = {}
+    running = {}
+    pending = list(pipeline)
+    progress = 0
+    try:
+        while pending or running:
+            for stage in [s for s in pending if all(dep in results for dep in s[1])]:
+                pending.remove(stage)
+                job.report(stage[0], progress, _running_message(running, stage))
+                running[start_stage(stage[0], results)] = stage + (time.perf_counter(),)
+            if not running:
+                raise ValueError(f"Unsatisfiable stage dependencies: {[s[0] for s in pending]}")
+
+            done, _ = wait(running, timeout=CANCEL_POLL, return_when=FIRST_COMPLETED)
+            if job.cancelled.is_set():
+                raise JobCancelled()
+            for future in done:
+                name, _, weight, _, started = running.pop(future)
+                try:
+                    results[name], stage_metrics = future.result()
+                except Exception:
+                    job.fail(name)
+                    raise
+                # Wall time includes any wait for a free worker
+                job.metrics.add_span(f"stage.{name}", time.perf_counter() - started)
+                job.metrics.merge(stage_metrics, prefix=f"{name}/")
+                progress += weight
+                job.report(name, progress, _running_message(running), state="done")
+    finally:
+        for future in running:
+            if not future.cancel():
+                job.orphans.append(future)
+        if job.orphans and job.cancel_event is not None:
+            job.cancel_event.set()
+    return results
+
+def run_render(job, cpu_pool, io_pool, cache_root=DEFAULT_ROOT):
+    # Audio and image in parallel, then the video once both exist
+    track_length, music_type, seed = job.params["track_length"], job.params["music_type"], job.params["seed"]
+    profiler = job.params.get("profiler")
+    progressive = job.params.get("progressive", False)
+    if progressive:
+        job.partial_path = ArtifactCache(cache_root).partial_path(audio_key(track_length, music_type, seed), ".mp3")
+
+    def start_stage(name, results):
+        if name == "audio":
+            return cpu_pool.submit(cancellation.run_watched, job.cancel_event, metrics.run_instrumented, profiler,
+                                   build_audio, track_length, music_type, seed, cache_root, progressive)
+        if name == "image":
+            return io_pool.submit(metrics.run_instrumented, profiler, get_background, music_type, seed,
+                                  job.params["image_source"], cache_root)
+        return cpu_pool.submit(cancellation.run_watched, job.cancel_event, metrics.run_instrumented, profiler,
+                               build_video, results["audio"], results["image"], cache_root, job.params["video_mode"],
+                               music_type, track_length)
+
+    results = run_pipeline(job, start_stage)
+    job.report("done", 100, "✨ Creation Complete!", state="done")
+    return {"audio_path": results["audio"], "image_path": results["image"], "video_path": results["video"], "seed": seed}
+
+class JobManager:
+    def __init__(self, max_running=2, max_queued=8, cpu_workers=None, cache_root=DEFAULT_ROOT, keep_finished=600,
+                 metrics_file=METRICS_FILE):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.cache_root = cache_root
+        self.keep_finished = keep_finished
+        self.metrics_file = metrics_file
+        # Running totals over every finished job
+        self.metrics = metrics.Metrics()
+        self._runner = ThreadPoolExecutor(max_running, thread_name_prefix="render-job")
+        self._cpu_workers = cpu_workers or max_running
+        self._mp_context = worker_context()
+        self._cpu_pool = ProcessPoolExecutor(self._cpu_workers, mp_context=self._mp_context, initializer=warm_up)
+        self._io_pool = ThreadPoolExecutor(max_running, thread_name_prefix="render-io")
+        # Serves the jobs' cancel events; started with the first one
+        self._manager = None
+        self._manager_lock = threading.Lock()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, track_length, music_type, seed, image_source="auto", video_mode="still", profiler=None,
+               progressive=False):
+        # Queue a render and return its id; raises QueueFull when the backlog is at its limit
+        with self._lock:
+            self._purge()
+            active = sum(1 for job in self._jobs.values() if job.status in ("queued", "running"))
+            # Cancelled stages hold their worker until they notice
+            stopping = sum(1 for job in self._jobs.values() for future in job.orphans if not future.done())
+            if active + stopping >= self.max_running + self.max_queued:
+                raise QueueFull(f"{active} renders already in progress, try again shortly")
+            job = Job({"track_length": track_length, "music_type": music_type, "seed": seed,
+                       "image_source": image_source, "video_mode": video_mode, "profiler": profiler,
+                       "progressive": progressive})
+            self._jobs[job.id] = job
+        self._runner.submit(self._run, job)
+        return job.id
+
+    def warm_up(self):
+        # Start the worker processes now rather than on the first job, and warm
+        # this process too, which renders draft previews itself
+        started = [self._cpu_pool.submit(os.getpid) for _ in range(self._cpu_workers)]
+        self._cancel_event()
+        warm_up()
+        wait(started)
+
+    def _cancel_event(self):
+        with self._manager_lock:
+            if self._manager is None:
+                self._manager = (self._mp_context or multiprocessing).Manager()
+            return self._manager.Event()
+
+    def _run(self, job):
+        if job.cancelled.is_set():
+            job.close("cancelled")
+            return
+        job.cancel_event = self._cancel_event()
+        with job._lock:
+            job.status = "running"
+        try:
+            job.close("done", result=run_render(job, self._cpu_pool, self._io_pool, self.cache_root))
+        except JobCancelled:
+            job.close("cancelled")
+        except Exception as e:
+            job.close("failed", error=f"Error during {job.stage} stage: {e}")
+            job.traceback = traceback.format_exc()
+        self._export(job)
+
+    def _export(self, job):
+        # Log the job's metrics and fold them into the exported totals
+        snapshot = job.metrics.snapshot()
+        metrics.log_metrics(snapshot, job=job.id, status=job.status, **job.params)
+        snapshot["counters"][f"jobs_{job.status}"] = 1
+        snapshot["profiles"] = {}
+        self.metrics.merge(snapshot)
+        if self.metrics_file:
+            try:
+                metrics.write_prometheus(self.metrics.snapshot(), self.metrics_file)
+            except OSError:
+                metrics.logger.exception("Could not write %s", self.metrics_file)
+
+    def _purge(self):
+        # Forget finished jobs nobody has polled for a while, once their stages have all stopped
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and now - j.finished > self.keep_finished
+                       and all(future.done() for future in j.orphans)]:
+            del self._jobs[job_id]
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            queued = [j for j in self._jobs.values() if j.status == "queued"]
+        snapshot = job.snapshot()
+        if snapshot["status"] == "queued":
+            snapshot["position"] = sum(1 for j in queued if j.created < job.created)
+        return snapshot
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.cancelled.set()
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            job.cancelled.set()
+            if job.cancel_event is not None:
+                job.cancel_event.set()
+        self._runner.shutdown(wait=False, cancel_futures=True)
+        self._cpu_pool.shutdown(wait=False, cancel_futures=True)
+        self._io_pool.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
@@ -0,0 +1,160 @@
+import argparse
+import os
+import tempfile
+
+import numpy as np
+
+import dsp
+from audio_generator import SAMPLE_RATE, mix_blocks, phrase_cycle, prepare_track
+from constants import MUSIC_TYPES
+from encoder import AAC_BITRATE, MP3_BITRATE, int16_chunks, pcm_input, run_ffmpeg, still_video
+
+# Long-form mode: hours of audio for the cost of one loop. A seamless cycle of
+# phrases is rendered and encoded once, and the full-length MP3/MP4 are
+# stream-looped from those packets with -c copy, so cost follows the loop
+# length, not the output length.
+
+# MP3 (1152) and AAC (1024) frame sizes both divide this, so a loop of a
+# multiple of it is a whole number of frames in either codec
+FRAME_QUANTUM = 9216
+
+# Crossfade at the loop seam, in seconds
+LOOP_CROSSFADE = 0.25
+
+# The loop is encoded this many times back to back and only the second copy's
+# frames are kept, so they carry full codec context on both sides
+ENCODE_REPEATS = 3
+
+# Length of the still-image video that is looped under the audio
+LOOP_VIDEO_SEC = 30
+
+# Slowest tempo get_style_settings picks; bounds how far a loop can run
+MIN_BPM = 40
+
+MP3_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MP3_SAMPLE_RATES = [44100, 48000, 32000]
+
+def render_loop(style, loop_bars=8, variations=2, seed=None):
+    # One seamless cycle of the pattern as int16. Two cycles plus the crossfade
+    # are mixed; the second is kept (so reverb and notes ringing over from the
+    # cycle before are in it) and its head fades in from the true continuation
+    # past its end. Returns (pcm, plan).
+    horizon = (2 * phrase_cycle(variations) + 1) * loop_bars * 240 / MIN_BPM
+    plan = prepare_track(horizon, style, loop_bars=loop_bars, variations=variations, seed=seed,
+                         period_quantum=FRAME_QUANTUM)
+    cycle = phrase_cycle(variations) * plan["period"]
+    fade = int(LOOP_CROSSFADE * SAMPLE_RATE)
+
+    mix = np.empty(2 * cycle + fade, dtype=dsp.DTYPE)
+    pos = 0
+    for block in mix_blocks(plan):
+        n = min(len(block), len(mix) - pos)
+        mix[pos:pos + n] = block[:n]
+        pos += n
+        if pos == len(mix):
+            break
+
+    loop = mix[cycle:2 * cycle]
+    after = mix[2 * cycle:]
+    loop[:fade] -= after
+    loop[:fade] *= np.linspace(0, 1, fade, dtype=dsp.DTYPE)
+    loop[:fade] += after
+
+    max_val = dsp.peak(loop)
+    return dsp.to_int16(loop, 0.95 / max_val if max_val > 0 else 0.0), plan
+
+def _split_frames(data, frame_length):
+    frames = []
+    pos = 0
+    while pos + 7 <= len(data):
+        length = frame_length(data, pos)
+        frames.append(data[pos:pos + length])
+        pos += length
+    return frames
+
+def _mp3_frame_length(data, pos):
+    # MPEG-1 Layer III header: bitrate index, sample rate index, padding bit
+    if data[pos] != 0xFF or data[pos + 1] & 0xFE != 0xFA:
+        raise ValueError(f"Not an MPEG-1 Layer III frame at byte {pos}")
+    bitrate = MP3_BITRATES[data[pos + 2] >> 4] * 1000
+    sample_rate = MP3_SAMPLE_RATES[(data[pos + 2] >> 2) & 3]
+    return 144 * bitrate // sample_rate + ((data[pos + 2] >> 1) & 1)
+
+def _adts_frame_length(data, pos):
+    if data[pos] != 0xFF or data[pos + 1] & 0xF0 != 0xF0:
+        raise ValueError(f"Not an ADTS frame at byte {pos}")
+    return ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+
+def encode_loop(pcm, mp3_path, aac_path, sample_rate=SAMPLE_RATE):
+    # Encode the loop to raw MP3 and ADTS AAC whose frames can be repeated back to
+    # back without a gap: no bit reservoir, no Xing/ID3 headers, and only the
+    # frames of a copy that was encoded between two other copies. AAC noise
+    # substitution is off so every repeat decodes to the same samples.
+    if len(pcm) % FRAME_QUANTUM:
+        raise ValueError(f"Loop length {len(pcm)} is not a multiple of {FRAME_QUANTUM} samples")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp3_all = os.path.join(tmp_dir, "loop.mp3")
+        aac_all = os.path.join(tmp_dir, "loop.aac")
+        run_ffmpeg(pcm_input(sample_rate) + [
+            "-map", "0:a", "-c:a", "libmp3lame", "-b:a", MP3_BITRATE, "-reservoir", "0",
+            "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", mp3_all,
+            "-map", "0:a", "-c:a", "aac", "-b:a", AAC_BITRATE, "-aac_pns", "0", "-f", "adts", aac_all,
+        ], int16_chunks([pcm] * ENCODE_REPEATS))
+
+        for src, dst, frame_length, frame_samples in [(mp3_all, mp3_path, _mp3_frame_length, 1152),
+                                                      (aac_all, aac_path, _adts_frame_length, 1024)]:
+            with open(src, "rb") as f:
+                frames = _split_frames(f.read(), frame_length)
+            per_loop = len(pcm) // frame_samples
+            with open(dst, "wb") as f:
+                f.write(b"".join(frames[per_loop:2 * per_loop]))
+    return mp3_path, aac_path
+
+def render_longform(duration_sec, style="Lo-Fi Beats", mp3_path=None, mp4_path=None, image_path=None,
+                    loop_bars=8, variations=2, seed=None):
+    # Multi-hour MP3 and/or still-image MP4 built from one encoded loop
+    if not mp3_path and not mp4_path:
+        raise ValueError("Nothing to render: pass mp3_path and/or mp4_path")
+    if mp4_path and not image_path:
+        raise ValueError("An MP4 needs an image_path")
+
+    pcm, plan = render_loop(style, loop_bars, variations, seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        loop_mp3, loop_aac = encode_loop(pcm, os.path.join(tmp_dir, "loop.mp3"), os.path.join(tmp_dir, "loop.aac"))
+
+        args = []
+        if mp3_path:
+            os.makedirs(os.path.dirname(mp3_path) or ".", exist_ok=True)
+            args += ["-stream_loop", "-1", "-i", loop_mp3]
+        if mp4_path:
+            os.makedirs(os.path.dirname(mp4_path) or ".", exist_ok=True)
+            loop_video = still_video(image_path, os.path.join(tmp_dir, "loop.mp4"), LOOP_VIDEO_SEC)
+            args += ["-stream_loop", "-1", "-i", loop_aac, "-stream_loop", "-1", "-i", loop_video]
+        if mp3_path:
+            args += ["-map", "0:a", "-c", "copy", "-t", f"{duration_sec:.3f}", mp3_path]
+        if mp4_path:
+            audio, video = (1, 2) if mp3_path else (0, 1)
+            args += ["-map", f"{video}:v", "-map", f"{audio}:a", "-c", "copy", "-bsf:a", "aac_adtstoasc",
+                     "-t", f"{duration_sec:.3f}", "-movflags", "+faststart", mp4_path]
+        run_ffmpeg(args)
+
+    return {"mp3_path": mp3_path, "mp4_path": mp4_path, "seed": plan["seed"], "loop_sec": len(pcm) / SAMPLE_RATE}
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a long-form lofi video from one seamless loop")
+    parser.add_argument("hours", type=float)
+    parser.add_argument("--style", choices=MUSIC_TYPES, default="Lo-Fi Beats")
+    parser.add_argument("--image", help="background image; required for --mp4")
+    parser.add_argument("--mp3")
+    parser.add_argument("--mp4")
+    parser.add_argument("--loop-bars", type=int, default=8)
+    parser.add_argument("--variations", type=int, default=2)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    result = render_longform(args.hours * 3600, args.style, args.mp3, args.mp4, args.image,
+                             args.loop_bars, args.variations, args.seed)
+    print(f"Rendered {args.hours:g} h from a {result['loop_sec']:.1f} s loop (seed {result['seed']})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Lightweight render instrumentation. Code under test calls span()/count(),
+# which are no-ops unless a recorder is active in the current context, so the
+# engine pays nothing outside an instrumented job. Spans accumulate total time
+# and call count per name: render phases run interleaved inside generators, so
+# one phase is many short spans rather than one long one.
+
+PROFILERS = ["cprofile", "tracemalloc"]
+
+# Lines of profiler output kept per stage
+PROFILE_LINES = 25
+
+logger = logging.getLogger("lofi.metrics")
+
+_active = contextvars.ContextVar("metrics", default=None)
+
+class Metrics:
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self.profiles = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds, calls=1):
+        with self._lock:
+            total = self.spans.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, snapshot, prefix=""):
+        # Fold another recorder's snapshot in; span names get `prefix`, counters add up
+        for name, entry in snapshot["spans"].items():
+            self.add_span(prefix + name, entry["seconds"], entry["calls"])
+        for name, n in snapshot["counters"].items():
+            self.count(name, n)
+        with self._lock:
+            for name, text in snapshot["profiles"].items():
+                self.profiles[prefix + name] = text
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "spans": {name: {"seconds": s, "calls": c} for name, (s, c) in self.spans.items()},
+                "counters": dict(self.counters),
+                "profiles": dict(self.profiles),
+            }
+
+@contextlib.contextmanager
+def record(metrics=None):
+    # Make `metrics` (or a fresh recorder) the target of span()/count() in this context
+    metrics = metrics if metrics is not None else Metrics()
+    token = _active.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _active.reset(token)
+
+def active():
+    return _active.get()
+
+@contextlib.contextmanager
+def span(name):
+    metrics = _active.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_span(name, time.perf_counter() - start)
+
+def lap(name, start):
+    # Record the time since `start` (a time.perf_counter() reading) as one call
+    # of span `name`; for timing a block without re-indenting it
+    metrics = _active.get()
+    if metrics is not None:
+        metrics.add_span(name, time.perf_counter() - start)
+
+def count(name, n=1):
+    metrics = _active.get()
+    if metrics is not None:
+        metrics.count(name, n)
+
+@contextlib.contextmanager
+def capture(profiler, name="profile"):
+    # Optional cProfile or tracemalloc capture; the report lands in the active
+    # recorder's profiles under `name`
+    if not profiler:
+        yield
+        return
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler!r}, expected one of {PROFILERS}")
+
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            _store_profile(name, out.getvalue())
+        return
+
+    # tracemalloc is process wide; leave it running if someone else started it
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:PROFILE_LINES]
+        if started:
+            tracemalloc.stop()
+        _store_profile(name, "\n".join([f"Peak traced memory: {peak / 2**20:.1f} MiB"] + [str(stat) for stat in top]))
+
+def _store_profile(name, text):
+    metrics = _active.get()
+    if metrics is not None:
+        with metrics._lock:
+            metrics.profiles[name] = text
+
+def run_instrumented(profiler, fn, *args):
+    # Call fn under a fresh recorder (and optional profiler). Returns (result,
+    # snapshot). Top level so process pools can pickle it.
+    with record() as metrics, capture(profiler):
+        result = fn(*args)
+    return result, metrics.snapshot()
+
+def log_metrics(snapshot, **fields):
+    # One structured (JSON) log line per finished job
+    logger.info(json.dumps({"event": "render_metrics", **fields, "spans": snapshot["spans"],
+                            "counters": snapshot["counters"]}, sort_keys=True, default=str))
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def prometheus_text(snapshot, prefix="lofi", gauges=None):
+    # Prometheus text exposition format: spans as seconds/calls counters
+    # labelled by span, counters as <prefix>_<name>_total, plus any gauges given
+    lines = [
+        f"# HELP {prefix}_span_seconds_total Time spent in each render span",
+        f"# TYPE {prefix}_span_seconds_total counter",
+    ]
+    for name, entry in sorted(snapshot["spans"].items()):
+        lines.append(f'{prefix}_span_seconds_total{{span="{name}"}} {entry["seconds"]:.6f}')
+    lines += [f"# TYPE {prefix}_span_calls_total counter"]
+    for name, entry in sorted(snapshot["spans"].items()):
+        lines.append(f'{prefix}_span_calls_total{{span="{name}"}} {entry["calls"]}')
+    for name, n in sorted(snapshot["counters"].items()):
+        metric = f"{prefix}_{_metric_name(name)}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {n}"]
+    for name, value in sorted((gauges or {}).items()):
+        metric = f"{prefix}_{_metric_name(name)}"
+        lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(snapshot, path):
+    # Atomic replace, so a textfile collector never reads a half-written file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".metrics.", dir=os.path.dirname(path) or ".")
+    with os.fdopen(fd, "w") as f:
+        f.write(prometheus_text(snapshot))
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,223 @@
+from functools import lru_cache
+
+import numpy as np
+
+import dsp
+from constants import SAMPLE_RATE
+
+# Instrument buses, in the row order of the (N_BUSES, n) blocks the renderer produces
+BUS_KEYS = 0
+BUS_MELODY = 1
+BUS_DRUMS = 2
+BUS_CRACKLE = 3
+N_BUSES = 4
+BUS_NAMES = ["keys", "melody", "drums", "crackle"]
+
+# Wet signals that behave like noise (reverb) are bounded at this many sigmas
+NOISE_PEAK = 4.0
+
+# Inaudible DC offset fed into IIR filters so that silent stretches decay to it
+# instead of into denormals, which make lfilter ~20x slower
+DENORMAL_GUARD = 1e-20
+
+# Impulse responses count as rung out below this fraction of their peak
+# (-120 dB, far under 16-bit resolution)
+RING_FLOOR = 1e-6
+
+# Every effect is linear and time-invariant. Most are stateless: render(x) is
+# the response to x from silence, rung out, i.e. len(x) + effect.ring samples,
+# and pieces of a signal rendered apart and overlap-added at their offsets give
+# the response to the whole. So a track can be mixed block by block, or segment
+# by segment on other processes, and streaming, tiled and in-memory renders stay
+# interchangeable. Recursive effects that ring on for seconds (streaming = True)
+# would spend most of each short block ringing out; they process() their input
+# as one stateful pass over the track instead, which is cheap.
+#
+# SciPy is imported where it is used: scipy.signal alone takes about a second
+# to load, which would otherwise land on every importer of the render stack.
+
+class FeedbackDelay:
+    # Multi-tap echo. The line recirculates from its longest tap, and each tap
+    # is read as (delay_sec, gain).
+    streaming = True
+
+    def __init__(self, taps, feedback=0.3, sample_rate=SAMPLE_RATE):
+        self.taps = [(int(delay * sample_rate), gain) for delay, gain in taps]
+        self.length = max(delay for delay, _ in self.taps)
+        self.feedback = feedback
+        self.history = np.zeros(self.length, dtype=dsp.DTYPE)
+        self.gain_bound = sum(abs(gain) for _, gain in self.taps) / (1 - abs(feedback))
+
+    def process(self, x):
+        n = len(x)
+        size = self.length
+        # line[size + i] holds the delay line input for sample i of this block
+        line = np.empty(size + n, dtype=dsp.DTYPE)
+        line[:size] = self.history
+        for start in range(0, n, size):
+            end = min(n, start + size)
+            np.multiply(line[start:end], self.feedback, out=line[size + start:size + end])
+            line[size + start:size + end] += x[start:end]
+
+        wet = np.zeros(n, dtype=dsp.DTYPE)
+        for delay, gain in self.taps:
+            wet += gain * line[size - delay:size - delay + n]
+        self.history = line[n:].copy()
+        return wet
+
+class TapeFilter:
+    # Butterworth low-pass that takes the digital edge off a bus
+    streaming = False
+
+    def __init__(self, cutoff=4500, order=2, sample_rate=SAMPLE_RATE):
+        from scipy import signal
+        b, a = signal.butter(order, min(cutoff, sample_rate * 0.45), fs=sample_rate)
+        self.b = b.astype(dsp.DTYPE)
+        self.a = a.astype(dsp.DTYPE)
+        impulse = np.zeros(4096)
+        impulse[0] = 1
+        response = np.abs(signal.lfilter(b, a, impulse))
+        self.gain_bound = float(response.sum())
+        self.ring = int(np.flatnonzero(response > RING_FLOOR * response.max())[-1]) + 1
+
+    def render(self, x):
+        from scipy import signal
+        padded = np.full(len(x) + self.ring, DENORMAL_GUARD, dtype=dsp.DTYPE)
+        padded[:len(x)] += x
+        return signal.lfilter(self.b, self.a, padded)
+
+@lru_cache(maxsize=8)
+def impulse_response(decay_sec, tone, seed, sample_rate):
+    # Seeded, darkened, exponentially decaying noise with unit energy
+    from scipy import signal
+    length = int(decay_sec * sample_rate)
+    t = np.arange(length) / sample_rate
+    ir = np.random.default_rng(seed).standard_normal(length) * np.exp(-6.9 * t / decay_sec) # -60 dB at decay_sec
+    ir = signal.lfilter(*signal.butter(1, tone, fs=sample_rate), ir)
+    ir = (ir / np.sqrt(np.sum(ir ** 2))).astype(dsp.DTYPE)
+    ir.setflags(write=False)
+    return ir
+
+@lru_cache(maxsize=32)
+def _ir_spectrum(params, nfft):
+    import scipy.fft
+    return scipy.fft.rfft(impulse_response(*params), nfft)
+
+class Reverb:
+    # Convolution with impulse_response(), by FFT. Pickles as its parameters,
+    # so process pools rebuild the IR (once per process) instead of shipping it.
+    streaming = False
+
+    def __init__(self, decay_sec=1.5, tone=6000, seed=0, sample_rate=SAMPLE_RATE):
+        self.params = (decay_sec, tone, seed, sample_rate)
+        self.ir = impulse_response(*self.params)
+        self.ring = len(self.ir) - 1
+        # Unit-energy IR: the wet signal is about as loud as the send (RMS)
+        self.gain_bound = NOISE_PEAK
+
+    def __reduce__(self):
+        return Reverb, self.params
+
+    def render(self, x):
+        import scipy.fft
+        n = len(x) + self.ring
+        nfft = scipy.fft.next_fast_len(n, real=True)
+        return scipy.fft.irfft(scipy.fft.rfft(x, nfft) * _ir_spectrum(self.params, nfft), nfft)[:n]
+
+class Bus:
+    # Insert effects run in series on the bus; sends feed named mixer returns
+
+    def __init__(self, gain=1.0, inserts=(), sends=None):
+        self.gain = gain
+        self.inserts = list(inserts)
+        self.sends = dict(sends or {})
+
+class Mixer:
+    # Sums the buses into one master signal. Each return effect processes the
+    # sum of its sends once per block, so effect cost follows track length, not
+    # note count.
+
+    def __init__(self, buses, returns=None):
+        self.buses = buses
+        self.returns = dict(returns or {})
+        self.streamed = [name for name, effect in self.returns.items() if effect.streaming]
+        # How far a rendered block rings on past its end, through the inserts and then a return
+        self.insert_ring = max(sum(effect.ring for effect in bus.inserts) for bus in buses)
+        self.ring = self.insert_ring + max((effect.ring for name, effect in self.returns.items()
+                                            if name not in self.streamed), default=0)
+        self._carry = None
+
+    def render(self, block):
+        # Mix a dry (N_BUSES, n) block on its own, from silence, rung out, as
+        # far as stateless effects go: a (1 + len(self.streamed), n + self.ring)
+        # block to overlap-add at the block's offset and hand to finish(). Row 0
+        # is the mix so far, the others the sends to the streamed returns.
+        n = block.shape[-1]
+        out = np.zeros((1 + len(self.streamed), n + self.ring), dtype=dsp.DTYPE)
+        sends = {name: np.zeros(n + self.insert_ring, dtype=dsp.DTYPE) for name in self.returns}
+        sends.update(zip(self.streamed, out[1:]))
+        for bus, x in zip(self.buses, block):
+            for effect in bus.inserts:
+                x = effect.render(x)
+            x = x * bus.gain
+            out[0, :len(x)] += x
+            for name, level in bus.sends.items():
+                sends[name][:len(x)] += level * x
+        for name, effect in self.returns.items():
+            if name not in self.streamed:
+                wet = effect.render(sends[name])
+                out[0, :len(wet)] += wet
+        return out
+
+    def finish(self, rendered):
+        # The master for the next stretch of overlap-added render() output, in
+        # track order: adds the streamed returns, run over their sends
+        master = rendered[0]
+        for name, send in zip(self.streamed, rendered[1:]):
+            master += self.returns[name].process(send)
+        return master
+
+    def process(self, block):
+        # The next n samples of the mix: render(), with the rings of the blocks
+        # before it added in, then finish()
+        n = block.shape[-1]
+        rendered = self.render(block)
+        if self._carry is not None:
+            rendered[:, :self.ring] += self._carry
+        self._carry = rendered[:, n:].copy()
+        return self.finish(rendered[:, :n])
+
+    def peak_bound(self, bus_bounds):
+        # Bound on |master| given a bound on each dry bus
+        total = 0.0
+        for bus, bound in zip(self.buses, bus_bounds):
+            for effect in bus.inserts:
+                bound *= effect.gain_bound
+            bound *= abs(bus.gain)
+            total += bound * (1 + sum(abs(level) * self.returns[name].gain_bound for name, level in bus.sends.items()))
+        return total
+
+def build_mixer(style, use_delay=False, sample_rate=SAMPLE_RATE):
+    # Per-style bus layout: tape low-pass everywhere, echo for the styles that
+    # used to delay every note, reverb for the slower, roomier ones
+    tape = {"8-Bit": 9000, "Synth": 6500}.get(style, 4500)
+    buses = [
+        Bus(inserts=[TapeFilter(tape, sample_rate=sample_rate)]),           # keys
+        Bus(inserts=[TapeFilter(tape, sample_rate=sample_rate)]),           # melody
+        Bus(inserts=[TapeFilter(tape * 1.5, sample_rate=sample_rate)]),     # drums
+        Bus(inserts=[TapeFilter(3000, sample_rate=sample_rate)]),           # crackle
+    ]
+    returns = {}
+
+    if use_delay:
+        returns["delay"] = FeedbackDelay([(0.25, 0.3), (0.4, 0.4)], feedback=0.3, sample_rate=sample_rate)
+        buses[BUS_KEYS].sends["delay"] = 0.8
+        buses[BUS_MELODY].sends["delay"] = 1.0
+
+    if style in ["Ambient", "Meditation", "Piano", "Jazz Hop"]:
+        long_tail = style in ["Ambient", "Meditation"]
+        returns["reverb"] = Reverb(2.5 if long_tail else 1.2, sample_rate=sample_rate)
+        buses[BUS_KEYS].sends["reverb"] = 0.35 if long_tail else 0.2
+        buses[BUS_MELODY].sends["reverb"] = 0.3 if long_tail else 0.15
+
+    return Mixer(buses, returns)
@@ -0,0 +1,93 @@
+import numpy as np
+from constants import SAMPLE_RATE
+
+# Wavetables hold one cycle of 2**TABLE_BITS samples and are read with a 32-bit
+# fixed-point phase accumulator whose top TABLE_BITS bits index the table. At this
+# size the nearest-sample read is as precise as the 16-bit output, so no
+# interpolation pass is needed.
+TABLE_BITS = 16
+TABLE_SIZE = 1 << TABLE_BITS
+_FRAC_BITS = 32 - TABLE_BITS
+
+# Band-limited tables are built per octave, starting at this frequency
+LOWEST_FREQ = 20.0
+OCTAVES = 11
+
+def _sine(h):
+    return (h == 1).astype(np.float64)
+
+def _square(h):
+    return np.where(h % 2 == 1, 1.0 / h, 0.0)
+
+def _saw(h):
+    return 1.0 / h
+
+def _rhodes(h):
+    # Mellow fundamental, a few low partials and a faint tine "bell" on the 7th
+    amps = np.zeros(len(h))
+    for harmonic, amp in {1: 1.0, 2: 0.35, 3: 0.12, 4: 0.05, 7: 0.03}.items():
+        amps[h == harmonic] = amp
+    return amps
+
+def _pad(h):
+    # Saw with a steep roll-off, read twice with a slight detune
+    return 1.0 / h ** 2
+
+# name -> (harmonic amplitudes as a function of harmonic number, detune in cents)
+SHAPES = {
+    "sine": (_sine, 0),
+    "square": (_square, 0),
+    "saw": (_saw, 0),
+    "rhodes": (_rhodes, 0),
+    "pad": (_pad, 7),
+}
+
+_tables = {}
+
+def _build(name):
+    # One table per octave, each holding only the harmonics that stay below
+    # Nyquist for the top note of that octave
+    harmonics, _ = SHAPES[name]
+    h = np.arange(1, TABLE_SIZE // 2)
+    tables = np.empty((OCTAVES, TABLE_SIZE), dtype=np.float32)
+    for octave in range(OCTAVES):
+        top = LOWEST_FREQ * 2 ** (octave + 1)
+        spectrum = np.zeros(TABLE_SIZE // 2 + 1, dtype=np.complex128)
+        spectrum[1:TABLE_SIZE // 2] = -1j * harmonics(h) * (h * top < SAMPLE_RATE / 2)
+        cycle = np.fft.irfft(spectrum, TABLE_SIZE)
+        peak = np.abs(cycle).max()
+        tables[octave] = cycle / peak if peak > 0 else cycle
+    return tables.ravel()
+
+def get_table(name):
+    # Flattened (OCTAVES * TABLE_SIZE) table for a shape, built on first use
+    if name not in _tables:
+        _tables[name] = _build(name)
+    return _tables[name]
+
+def _read(tables, freqs, length, sample_rate, phase):
+    octave = np.log2(np.maximum(freqs, LOWEST_FREQ) / LOWEST_FREQ).astype(np.uint32)
+    octave = np.minimum(octave, OCTAVES - 1)
+    step = np.round(freqs / sample_rate * 2 ** 32).astype(np.uint64).astype(np.uint32)
+
+    # uint32 arithmetic wraps, which is exactly the phase wrap we want
+    acc = step[:, None] * np.arange(length, dtype=np.uint32)
+    acc += np.uint32(int(phase % 1.0 * 2 ** 32))
+    acc >>= np.uint32(_FRAC_BITS)
+    acc += (octave << np.uint32(TABLE_BITS))[:, None]
+    return tables[acc]
+
+def oscillate(name, freqs, length, sample_rate=SAMPLE_RATE, phase=0.0):
+    # float32 array of shape (len(freqs), length): one row per frequency, each
+    # starting at `phase` (in cycles) and read from the named wavetable
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=np.float64))
+    tables = get_table(name)
+    _, detune = SHAPES[name]
+    if not detune:
+        return _read(tables, freqs, length, sample_rate, phase)
+
+    spread = 2 ** (detune / 1200)
+    out = _read(tables, freqs / spread, length, sample_rate, phase)
+    out += _read(tables, freqs * spread, length, sample_rate, phase + 0.25)
+    out *= 0.5
+    return out
@@ -0,0 +1,358 @@
+import argparse
+import json
+import queue
+import struct
+import subprocess
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import dsp
+import metrics
+from audio_generator import (LIMIT_CEILING, PREROLL_MARGIN, ROOT_FREQS, SAMPLE_RATE, _arrangement_rng,
+                             compile_arrangement, get_style_settings, limited, render_segment)
+from constants import MUSIC_TYPES
+from encoder import MP3_BITRATE, ffmpeg_exe, pcm_input
+from mixer import N_BUSES, build_mixer
+
+# Lofi radio: one endless render shared by every listener. A render thread keeps
+# LOOKAHEAD_SEC of audio queued ahead of a realtime clock; the clock thread hands
+# each block to every listener (and to one shared MP3 encoder), and plays
+# silence rather than stall if the render ever falls behind, counting an
+# underrun. Served over chunked HTTP as WAV or MP3, with /status and /metrics.
+
+# Phrases are compiled and rendered this many bars at a time
+PHRASE_BARS = 8
+
+# Every this many phrases the key moves, so the progression keeps evolving
+EVOLVE_PHRASES = 4
+
+# Seconds each style plays before crossfading into the next
+STYLE_SEC = 600
+CROSSFADE_SEC = 8
+
+# Blocks handed to listeners, and how far ahead of the clock the render runs
+BLOCK_SEC = 0.5
+LOOKAHEAD_SEC = 10
+
+# A listener this far behind is dropped instead of buffering forever
+LISTENER_QUEUE_SEC = 30
+
+# Recent audio sent to a new listener at once so its player starts without a wait
+BURST_SEC = 2
+
+class StyleStream:
+    # Endless mixed audio in one style: 8-bar phrases compiled back to back,
+    # each one's ringing tail overlap-added into the next, through one stateful
+    # mixer. Level is set once from the first phrase's mixed peak (with
+    # PREROLL_MARGIN to spare) and the streaming limiter handles the rest.
+
+    def __init__(self, style, seed_seq):
+        self.style = style
+        arrangement_seq, self.noise_seq = seed_seq.spawn(2)
+        self.rng = _arrangement_rng(arrangement_seq)
+        self.settings = get_style_settings(style, self.rng)
+        self.mixer = build_mixer(style, self.settings["use_delay"])
+        self.phrase_sec = 240 / self.settings["bpm"] * PHRASE_BARS
+        self.gain = None
+
+    def _evolve(self, index):
+        # Move to one of the style's other keys now and then
+        if index and index % EVOLVE_PHRASES == 0:
+            roots = [root for root in ROOT_FREQS if root != self.settings["root_freq"]]
+            self.settings = dict(self.settings, root_freq=self.rng.choice(roots))
+
+    def blocks(self):
+        carry = np.zeros((N_BUSES, 0), dtype=dsp.DTYPE)
+        index = 0
+        while True:
+            self._evolve(index)
+            start = int(index * self.phrase_sec * SAMPLE_RATE)
+            length = int((index + 1) * self.phrase_sec * SAMPLE_RATE) - start
+            events = compile_arrangement(self.phrase_sec, self.style, self.rng, self.settings)
+            buf = render_segment(events, 0, length, self.noise_seq, index)
+            if carry.shape[1] > buf.shape[1]:
+                buf = np.concatenate((buf, np.zeros((N_BUSES, carry.shape[1] - buf.shape[1]), dtype=dsp.DTYPE)), axis=1)
+            buf[:, :carry.shape[1]] += carry
+            carry = buf[:, length:]
+            block = self.mixer.process(buf[:, :length])
+            if self.gain is None:
+                self.gain = LIMIT_CEILING / max(dsp.peak(block) * PREROLL_MARGIN, 1e-9)
+            block *= self.gain
+            yield block
+            index += 1
+
+    def limited_blocks(self):
+        return limited(self.blocks())
+
+def _rechunk(blocks, size):
+    # Fixed-size float blocks from variable-size ones
+    pending = np.empty(0, dtype=dsp.DTYPE)
+    for block in blocks:
+        pending = np.concatenate((pending, block)) if len(pending) else block
+        while len(pending) >= size:
+            yield pending[:size]
+            pending = pending[size:]
+
+def radio_blocks(styles=MUSIC_TYPES, seed=None, style_sec=STYLE_SEC, crossfade_sec=CROSSFADE_SEC, block_sec=BLOCK_SEC):
+    # Yield (style, int16 block) forever, rotating through `styles` with an
+    # equal-power crossfade at each change
+    size = int(block_sec * SAMPLE_RATE)
+    seeds = np.random.SeedSequence(seed)
+    fade_blocks = max(1, int(crossfade_sec / block_sec))
+    style_blocks = max(fade_blocks + 1, int(style_sec / block_sec))
+    k = 0
+    current = _rechunk(StyleStream(styles[0], seeds.spawn(1)[0]).limited_blocks(), size)
+    while True:
+        style = styles[k % len(styles)]
+        for _ in range(style_blocks - fade_blocks):
+            yield style, dsp.to_int16(next(current))
+
+        k += 1
+        following = _rechunk(StyleStream(styles[k % len(styles)], seeds.spawn(1)[0]).limited_blocks(), size)
+        t = np.arange(fade_blocks * size, dtype=dsp.DTYPE).reshape(fade_blocks, size) / (fade_blocks * size)
+        fade_out, fade_in = np.cos(t * np.pi / 2), np.sin(t * np.pi / 2)
+        for i in range(fade_blocks):
+            mixed = next(current) * fade_out[i] + next(following) * fade_in[i]
+            yield styles[k % len(styles)] if i >= fade_blocks // 2 else style, dsp.to_int16(mixed)
+        current = following
+
+def wav_header(sample_rate=SAMPLE_RATE):
+    # Mono 16-bit WAV header with the sizes maxed out, as streaming players expect
+    return (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt " +
+            struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16) +
+            b"data" + struct.pack("<I", 0xFFFFFFFF))
+
+class Listener:
+    def __init__(self, kind, max_chunks):
+        self.kind = kind
+        self.chunks = queue.Queue(max_chunks)
+        self.dropped = False
+
+    def send(self, data):
+        try:
+            self.chunks.put_nowait(data)
+        except queue.Full:
+            self.dropped = True
+
+class Radio:
+    def __init__(self, styles=MUSIC_TYPES, seed=None, style_sec=STYLE_SEC, crossfade_sec=CROSSFADE_SEC,
+                 block_sec=BLOCK_SEC, lookahead_sec=LOOKAHEAD_SEC, mp3=True):
+        self.block_sec = block_sec
+        self.block_size = int(block_sec * SAMPLE_RATE)
+        self.lookahead_blocks = max(1, int(lookahead_sec / block_sec))
+        self.source = radio_blocks(styles, seed, style_sec, crossfade_sec, block_sec)
+        self.metrics = metrics.Metrics()
+        self.now_playing = styles[0]
+        self.started = None
+        # Lowest the lookahead has dropped to since the clock started
+        self.min_lookahead = lookahead_sec
+        self._ahead = deque()
+        self._ahead_changed = threading.Condition()
+        self._listeners = set()
+        # 16 encoder reads of 4 KiB are about BURST_SEC of MP3 at 192k
+        self._recent = {"wav": deque(maxlen=max(1, int(BURST_SEC / block_sec))), "mp3": deque(maxlen=16)}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._encoder = None
+        self._mp3 = mp3
+
+    def start(self):
+        if self._mp3:
+            self._encoder = subprocess.Popen(
+                [ffmpeg_exe(), "-hide_banner", "-loglevel", "error", *pcm_input(),
+                 "-c:a", "libmp3lame", "-b:a", MP3_BITRATE, "-flush_packets", "1", "-f", "mp3", "pipe:1"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+            threading.Thread(target=self._read_mp3, name="radio-mp3", daemon=True).start()
+        threading.Thread(target=self._render, name="radio-render", daemon=True).start()
+        threading.Thread(target=self._clock, name="radio-clock", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._ahead_changed:
+            self._ahead_changed.notify_all()
+        if self._encoder:
+            self._encoder.stdin.close()
+            self._encoder.wait()
+
+    def _render(self):
+        # Keep the lookahead full, timing every block against its duration
+        while not self._stop.is_set():
+            with self._ahead_changed:
+                while len(self._ahead) >= self.lookahead_blocks and not self._stop.is_set():
+                    self._ahead_changed.wait()
+            start = time.perf_counter()
+            style, block = next(self.source)
+            self.metrics.add_span("render", time.perf_counter() - start)
+            self.metrics.count("samples_rendered", len(block))
+            with self._ahead_changed:
+                self._ahead.append((style, block))
+                self._ahead_changed.notify()
+
+    def _clock(self):
+        # Release one block every block_sec of wall time, whatever the render does
+        silence = np.zeros(self.block_size, dtype=np.int16)
+        # Fill the lookahead before the clock starts, so the first phrase's render
+        # is not an underrun
+        with self._ahead_changed:
+            while len(self._ahead) < self.lookahead_blocks and not self._stop.is_set():
+                self._ahead_changed.wait(self.block_sec)
+        self.started = time.monotonic()
+        n = 0
+        while not self._stop.is_set():
+            delay = self.started + n * self.block_sec - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self._ahead_changed:
+                item = self._ahead.popleft() if self._ahead else None
+                self._ahead_changed.notify()
+                self.min_lookahead = min(self.min_lookahead, len(self._ahead) * self.block_sec)
+            if item is None:
+                self.metrics.count("underruns")
+                block = silence
+            else:
+                self.now_playing, block = item
+            self._broadcast("wav", block.tobytes())
+            if self._encoder:
+                try:
+                    self._encoder.stdin.write(block.tobytes())
+                except (BrokenPipeError, ValueError):
+                    self._encoder = None
+            self.metrics.count("samples_played", len(block))
+            n += 1
+
+    def _read_mp3(self):
+        while True:
+            data = self._encoder.stdout.read(4096) if self._encoder else b""
+            if not data:
+                return
+            self._broadcast("mp3", data)
+
+    def _broadcast(self, kind, data):
+        with self._lock:
+            self._recent[kind].append(data)
+            for listener in list(self._listeners):
+                if listener.kind == kind:
+                    listener.send(data)
+                    if listener.dropped:
+                        self._listeners.discard(listener)
+                        self.metrics.count("listeners_dropped")
+
+    def subscribe(self, kind):
+        if kind == "mp3" and not self._mp3:
+            raise ValueError("MP3 streaming is off")
+        listener = Listener(kind, max(4, int(LISTENER_QUEUE_SEC / self.block_sec)) * (8 if kind == "mp3" else 1))
+        with self._lock:
+            for data in self._recent[kind]:
+                listener.send(data)
+            self._listeners.add(listener)
+        self.metrics.count("listeners_joined")
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners.discard(listener)
+
+    def status(self):
+        snapshot = self.metrics.snapshot()
+        render = snapshot["spans"].get("render", {"seconds": 0.0})
+        rendered = snapshot["counters"].get("samples_rendered", 0) / SAMPLE_RATE
+        with self._lock:
+            listeners = len(self._listeners)
+        return {
+            "now_playing": self.now_playing,
+            "listeners": listeners,
+            "uptime_s": time.monotonic() - self.started if self.started else 0.0,
+            "lookahead_s": len(self._ahead) * self.block_sec,
+            "min_lookahead_s": self.min_lookahead,
+            # Seconds of audio rendered per second spent rendering; 1.0 is the realtime limit
+            "realtime_factor": rendered / render["seconds"] if render["seconds"] else None,
+            "underruns": snapshot["counters"].get("underruns", 0),
+        }
+
+def make_handler(radio):
+    class RadioHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/stream.wav":
+                self._stream("wav", "audio/wav", wav_header())
+            elif self.path == "/stream.mp3":
+                self._stream("mp3", "audio/mpeg", b"")
+            elif self.path == "/status":
+                self._send(200, "application/json", json.dumps(radio.status()).encode())
+            elif self.path == "/metrics":
+                status = radio.status()
+                # Underruns are already a counter
+                gauges = {k: v for k, v in status.items() if isinstance(v, (int, float)) and k != "underruns"}
+                self._send(200, "text/plain; version=0.0.4",
+                           metrics.prometheus_text(radio.metrics.snapshot(), "lofi_radio", gauges).encode())
+            else:
+                self._send(404, "text/plain", b"Try /stream.mp3, /stream.wav, /status or /metrics\n")
+
+        def _send(self, code, content_type, body):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self, kind, content_type, header):
+            try:
+                listener = radio.subscribe(kind)
+            except ValueError as e:
+                self._send(404, "text/plain", f"{e}\n".encode())
+                return
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                if header:
+                    self._chunk(header)
+                while not listener.dropped:
+                    self._chunk(listener.chunks.get())
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                radio.unsubscribe(listener)
+                self.close_connection = True
+
+        def _chunk(self, data):
+            self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+            radio.metrics.count("bytes_sent", len(data))
+
+        def log_message(self, format, *args):
+            pass
+
+    return RadioHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve an endless lofi radio stream over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--styles", nargs="+", choices=MUSIC_TYPES, default=MUSIC_TYPES)
+    parser.add_argument("--style-minutes", type=float, default=STYLE_SEC / 60)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--no-mp3", action="store_true", help="serve only the WAV stream (no ffmpeg encoder)")
+    args = parser.parse_args()
+
+    radio = Radio(args.styles, args.seed, args.style_minutes * 60, mp3=not args.no_mp3).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(radio))
+    server.daemon_threads = True
+    print(f"Lofi radio on http://{args.host}:{args.port}/stream.mp3 (and /stream.wav, /status, /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        radio.stop()
+
+if __name__ == "__main__":
+    main()
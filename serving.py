@@ -0,0 +1,174 @@
+import ipaddress
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+from artifact_cache import ArtifactCache, DEFAULT_ROOT
+
+# Read-only HTTP access to the artifact cache, so the UI can hand the browser a
+# URL instead of pushing file bytes through Streamlit on every rerun. Cached
+# files are content-addressed, so responses never change: they carry an ETag
+# and a year-long immutable Cache-Control, support Range requests (seeking in
+# the players), and are sent from the page cache with sendfile().
+
+# Local connections only unless set otherwise, e.g. 0.0.0.0 for other machines
+STATIC_HOST = os.environ.get("LOFI_STATIC_HOST", "127.0.0.1")
+# 0 disables the server; media then goes through Streamlit
+STATIC_PORT = int(os.environ.get("LOFI_STATIC_PORT", 8502))
+# Base URL the browser reaches the server at, e.g. behind a reverse proxy;
+# unset means the app's own host name on STATIC_PORT
+STATIC_URL = os.environ.get("LOFI_STATIC_URL")
+
+CONTENT_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".mp4": "video/mp4",
+    ".jpg": "image/jpeg",
+    ".png": "image/png",
+}
+
+# Only finished cache entries are served: <key><ext>, never temp or partial files
+ARTIFACT_NAME = re.compile(r"^([0-9a-f]{32})(\.[a-z0-9]+)$")
+
+def parse_range(header, size):
+    # (start, end) inclusive for a single "bytes=" range, None for the whole file;
+    # ValueError if it can't be satisfied
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class ArtifactServer:
+    def __init__(self, cache_root=DEFAULT_ROOT, host=STATIC_HOST, port=STATIC_PORT):
+        self.cache = ArtifactCache(cache_root)
+        self.server = ThreadingHTTPServer((host, port), make_handler(self))
+        self.server.daemon_threads = True
+        self.host = host
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="artifact-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reachable_from(self, hostname):
+        # Whether a browser that reaches the app at `hostname` can reach this
+        # server too: a loopback-only server is no use to one on another machine
+        return not is_loopback(self.host) or is_loopback(hostname)
+
+    def name(self, path):
+        # URL path for a file in the cache, None for anything else
+        name = os.path.basename(path)
+        resolved = self.resolve(name)
+        if resolved is None or os.path.abspath(path) != os.path.abspath(resolved):
+            return None
+        return name
+
+    def resolve(self, name):
+        # Cache path behind a URL path, None if it isn't a servable artifact
+        match = ARTIFACT_NAME.match(name)
+        if not match or match.group(2) not in CONTENT_TYPES:
+            return None
+        return self.cache.path(*match.groups())
+
+    def url(self, path, base, download=None):
+        # URL of a cached artifact under `base`; `download` makes the browser
+        # save it under that file name instead of playing it
+        name = self.name(path)
+        if name is None:
+            return None
+        url = f"{base.rstrip('/')}/{name}"
+        return f"{url}?download={quote(download)}" if download else url
+
+def make_handler(artifacts):
+    class ArtifactHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            self._serve(send_body=False)
+
+        def do_GET(self):
+            self._serve(send_body=True)
+
+        def _serve(self, send_body):
+            url = urlsplit(self.path)
+            path = artifacts.resolve(url.path.lstrip("/"))
+            try:
+                f = open(path, "rb") if path else None
+            except FileNotFoundError:
+                f = None
+            if f is None:
+                self._send_empty(404)
+                return
+
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                etag = f'"{os.path.basename(path).split(".")[0]}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._send_empty(304, etag)
+                    return
+                try:
+                    byte_range = parse_range(self.headers.get("Range", ""), size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                start, end = byte_range or (0, size - 1)
+                self.send_response(206 if byte_range else 200)
+                self.send_header("Content-Type", CONTENT_TYPES[os.path.splitext(path)[1]])
+                self.send_header("Content-Length", str(end - start + 1))
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self._cache_headers(etag)
+                download = parse_qs(url.query).get("download")
+                if download:
+                    self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(download[0])}")
+                self.end_headers()
+                if send_body and end >= start:
+                    try:
+                        self.connection.sendfile(f, start, end - start + 1)
+                    except (BrokenPipeError, ConnectionResetError):
+                        self.close_connection = True
+
+        def _cache_headers(self, etag):
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+
+        def _send_empty(self, code, etag=None):
+            self.send_response(code)
+            if etag:
+                self._cache_headers(etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return ArtifactHandler
@@ -0,0 +1,99 @@
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import utils
+
+# Remote backgrounds against a local stand-in for the image endpoint: retries,
+# the on-disk cache, the prefetcher and the offline fallback, with no network.
+
+STYLE = "Lo-Fi Beats"
+
+def jpeg_bytes():
+    buf = io.BytesIO()
+    Image.new("RGB", (16, 9), (40, 30, 60)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+class StubEndpoint:
+    # Answers every GET with the next status in `statuses`, then 200 and a JPEG
+    def __init__(self):
+        self.statuses = []
+        self.requests = []
+        self.body = jpeg_bytes()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/prompt/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append(self.path)
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                body = stub.body if status == 200 else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    stub = StubEndpoint()
+    monkeypatch.setattr(utils, "IMAGE_ENDPOINT", stub.url)
+    yield stub
+    stub.stop()
+
+def test_retry_recovers_from_503(endpoint, tmp_path):
+    endpoint.statuses = [503]
+    path = utils.get_background(STYLE, 7, "remote", str(tmp_path))
+    assert len(endpoint.requests) == 2
+    with open(path, "rb") as f:
+        assert f.read() == endpoint.body
+
+def test_cache_hit_makes_no_request(endpoint, tmp_path):
+    first = utils.get_background(STYLE, 7, "remote", str(tmp_path))
+    second = utils.get_background(STYLE, 7, "remote", str(tmp_path))
+    assert first == second
+    assert len(endpoint.requests) == 1
+
+def test_prefetcher_warms_a_style(endpoint, tmp_path):
+    total = len(utils.image_candidates(STYLE))
+    prefetcher = utils.ImagePrefetcher(styles=[STYLE], cache_root=str(tmp_path)).start()
+    try:
+        deadline = time.time() + 30
+        while prefetcher.fetched < total and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        prefetcher.stop()
+    assert prefetcher.stats()[STYLE] == (total, total)
+    assert prefetcher.fetched == total and prefetcher.failures == 0
+    assert len(endpoint.requests) == total
+    # Every later render of the style is a cache hit
+    requests = len(endpoint.requests)
+    utils.get_background(STYLE, 7, "remote", str(tmp_path))
+    assert len(endpoint.requests) == requests
+
+def test_auto_falls_back_to_procedural_when_down(endpoint, tmp_path):
+    endpoint.stop()
+    path = utils.get_background(STYLE, 7, "auto", str(tmp_path))
+    assert path == utils.procedural_image(STYLE, 7, str(tmp_path))
+    with Image.open(path) as image:
+        assert image.size == (1280, 720)
+    with pytest.raises(Exception):
+        utils.get_background(STYLE, 7, "remote", str(tmp_path))
@@ -1,25 +1,162 @@
 import requests
 import shutil
-from moviepy.editor import AudioFileClip, ImageClip
+import random
+import threading
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 
-def fetch_image(prompt, width=1280, height=720, output_filename="assets/generated/background_image.jpg"):
-    safe_prompt = prompt.replace(" ", "%20")
-    url = f"https://image.pollinations.ai/prompt/{safe_prompt}?width={width}&height={height}&nologo=true"
+from artifact_cache import ArtifactCache, artifact_key, DEFAULT_ROOT
+from backgrounds import generate_background
+from constants import MUSIC_TYPES, PROMPTS, STYLE_MODIFIERS
+
+# Remote backgrounds come from one pooled HTTP session with retry/backoff, are
+# cached on disk by (prompt, variant), and a background prefetcher keeps every
+# style's images warm so the image stage is usually a cache hit.
+
+IMAGE_ENDPOINT = os.environ.get("LOFI_IMAGE_ENDPOINT", "https://image.pollinations.ai/prompt/")
+IMAGE_TIMEOUT = 10
+
+# Where backgrounds come from: remote with a procedural fallback, remote only,
+# or procedural only (no network at all)
+IMAGE_SOURCES = ["auto", "remote", "procedural"]
+
+# Pictures per prompt. A render's seed picks one, so each style has a small,
+# finite set of images that can all be fetched ahead of time.
+IMAGE_VARIANTS = 2
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    # Shared keep-alive session; retries connection errors and 429/5xx with backoff
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=8, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+def fetch_image(prompt, width=1280, height=720, output_filename="assets/generated/background_image.jpg", seed=None):
+    url = f"{IMAGE_ENDPOINT}{quote(prompt)}?width={width}&height={height}&nologo=true"
+    if seed is not None:
+        url += f"&seed={seed}"
     
     # Ensure directory exists
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
     
-    response = requests.get(url, stream=True, timeout=10)
-    if response.status_code == 200:
-        with open(output_filename, 'wb') as f:
-            response.raw.decode_content = True
-            shutil.copyfileobj(response.raw, f)
-        return output_filename
-    else:
-        raise Exception(f"Failed to fetch image. Status: {response.status_code}")
+    with get_session().get(url, stream=True, timeout=IMAGE_TIMEOUT) as response:
+        if response.status_code == 200:
+            with open(output_filename, 'wb') as f:
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, f)
+            return output_filename
+        else:
+            raise Exception(f"Failed to fetch image. Status: {response.status_code}")
+
+def pick_image(music_type, seed):
+    # Base prompt, style modifier and variant, chosen from the seed so reruns match
+    rng = random.Random(seed)
+    base_prompt = rng.choice(PROMPTS.get(music_type, ["lofi cozy aesthetic"]))
+    prompt = f"{base_prompt}, {rng.choice(STYLE_MODIFIERS)}"
+    return prompt, rng.randrange(IMAGE_VARIANTS)
+
+def image_candidates(music_type):
+    # Every (prompt, variant) pick_image can return for a style
+    return [(f"{base_prompt}, {modifier}", variant)
+            for base_prompt in PROMPTS.get(music_type, ["lofi cozy aesthetic"])
+            for modifier in STYLE_MODIFIERS
+            for variant in range(IMAGE_VARIANTS)]
+
+def image_key(prompt, variant):
+    return artifact_key("image", prompt=prompt, seed=variant)
+
+def cached_image(prompt, variant, cache_root=DEFAULT_ROOT):
+    # Local path of the image for (prompt, variant), fetching it on a miss
+    return ArtifactCache(cache_root).get_or_create(
+        image_key(prompt, variant), ".jpg", lambda path: fetch_image(prompt, output_filename=path, seed=variant))
+
+def procedural_image(music_type, seed, cache_root=DEFAULT_ROOT):
+    # Offline stand-in: a seeded procedural scene for the style, no network
+    key = artifact_key("image", source="procedural", style=music_type, seed=seed)
+    return ArtifactCache(cache_root).get_or_create(
+        key, ".jpg", lambda path: generate_background(music_type, seed, output_filename=path))
+
+def get_background(music_type, seed, source="auto", cache_root=DEFAULT_ROOT):
+    # Background image path from the chosen IMAGE_SOURCES entry. "auto" tries the
+    # remote image and falls back to a procedural one if it can't be fetched.
+    if source != "procedural":
+        try:
+            return cached_image(*pick_image(music_type, seed), cache_root)
+        except Exception:
+            if source == "remote":
+                raise
+    return procedural_image(music_type, seed, cache_root)
+
+class ImagePrefetcher:
+    # Daemon thread that fetches, one at a time and round-robin across styles,
+    # every candidate image not yet in the cache. It idles once all are warm and
+    # backs off while the endpoint is failing.
+
+    def __init__(self, styles=MUSIC_TYPES, cache_root=DEFAULT_ROOT, idle=300, max_backoff=600):
+        self.styles = list(styles)
+        self.cache = ArtifactCache(cache_root)
+        self.idle = idle
+        self.max_backoff = max_backoff
+        self.fetched = 0
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="image-prefetch", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _missing(self, style):
+        # Existence check only: a get() would refresh LRU order for images nobody used
+        return [(prompt, variant) for prompt, variant in image_candidates(style)
+                if not os.path.exists(self.cache.path(image_key(prompt, variant), ".jpg"))]
+
+    def stats(self):
+        # Ready images per style, as (ready, total)
+        return {style: (len(image_candidates(style)) - len(self._missing(style)), len(image_candidates(style)))
+                for style in self.styles}
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            queue = [missing[0] for missing in map(self._missing, self.styles) if missing]
+            if not queue:
+                self._stop.wait(self.idle)
+                continue
+            for prompt, variant in queue:
+                if self._stop.is_set():
+                    return
+                try:
+                    cached_image(prompt, variant, self.cache.root)
+                    self.fetched += 1
+                    backoff = 1
+                except Exception:
+                    self.failures += 1
+                    self._stop.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    break
+
+# moviepy.editor loads moviepy's whole effects stack (and IPython, when
+# installed), so these legacy helpers import it on first use
 
 def create_video(audio_path, image_path, output_path="assets/generated/output_video.mp4"):
+    from moviepy.editor import AudioFileClip, ImageClip
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     audio = AudioFileClip(audio_path)
     video = ImageClip(image_path).set_duration(audio.duration)
@@ -29,6 +166,7 @@ def create_video(audio_path, image_path, output_path="assets/generated/output_vi
     return output_path
 
 def convert_wav_to_mp3(wav_path, output_path="assets/generated/output_audio.mp3"):
+    from moviepy.editor import AudioFileClip
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     audio = AudioFileClip(wav_path)
     audio.write_audiofile(output_path, codec='mp3')
@@ -0,0 +1,188 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+
+from constants import SAMPLE_RATE
+from encoder import AAC_ARGS, decode_pcm, run_ffmpeg
+
+# Audio-reactive video: spectrum bars over the background plus a glow that
+# pulses with loudness. All per-frame features come from one batched STFT, frames
+# are composited with whole-array NumPy ops directly in yuv420p, and go straight
+# into ffmpeg's stdin with no colour conversion left for it to do.
+
+FPS = 24
+WIDTH = 1280
+HEIGHT = 720
+
+N_FFT = 4096
+N_BARS = 64
+F_MIN = 40
+F_MAX = 16000
+FLOOR_DB = -48
+
+# Music falls off with frequency; lifting each band by this much per octave
+# above F_MIN keeps the treble bars moving
+TILT_DB_PER_OCTAVE = 4.5
+
+# Bars rise instantly and fall back over this many seconds
+RELEASE_SEC = 0.12
+
+# The glow is a lookup into this many pre-brightened copies of the background
+GLOW_LEVELS = 8
+GLOW_GAIN = 0.35
+
+# STFT frames and video frames are produced this many at a time
+BATCH = 256
+
+# Bar colour per style, bottom to top
+STYLE_COLORS = {
+    "Lo-Fi Beats": ("#ffcf7a", "#ff7aa2"),
+    "Piano": ("#ffe8b0", "#f2a48f"),
+    "Ambient": ("#6bd5ff", "#b78cff"),
+    "Synth": ("#ff2ad4", "#29f1ff"),
+    "Jazz Hop": ("#f5c26b", "#ff8c42"),
+    "Meditation": ("#ffffff", "#a9c6d9"),
+    "8-Bit": ("#7cff6b", "#ffe66b"),
+}
+
+def _rgb(hex_color):
+    return np.array([int(hex_color[i:i + 2], 16) for i in (1, 3, 5)], dtype=np.float32)
+
+def rgb_to_yuv420(image):
+    # (h, w, 3) RGB -> flat yuv420p bytes (BT.601 limited range, ffmpeg's default);
+    # h and w must be even
+    h, w, _ = image.shape
+    rgb = image.astype(np.float32)
+    y = rgb @ np.array([0.257, 0.504, 0.098], dtype=np.float32) + 16
+    # Chroma from the 2x2 mean
+    quad = rgb.reshape(h // 2, 2, w // 2, 2, 3).mean(axis=(1, 3))
+    u = quad @ np.array([-0.148, -0.291, 0.439], dtype=np.float32) + 128
+    v = quad @ np.array([0.439, -0.368, -0.071], dtype=np.float32) + 128
+    planes = [np.clip(np.rint(p), 0, 255).astype(np.uint8).ravel() for p in (y, u, v)]
+    return np.concatenate(planes)
+
+def band_matrix(n_bars=N_BARS, n_fft=N_FFT, sample_rate=SAMPLE_RATE):
+    # (bins, bars) averaging matrix over log-spaced bands; each band gets at least one bin
+    df = sample_rate / n_fft
+    edges = np.geomspace(F_MIN, F_MAX, n_bars + 1)
+    matrix = np.zeros((n_fft // 2 + 1, n_bars), dtype=np.float32)
+    for bar in range(n_bars):
+        lo = int(edges[bar] / df)
+        hi = max(lo + 1, int(np.ceil(edges[bar + 1] / df)))
+        matrix[lo:hi, bar] = 1 / (hi - lo)
+    return matrix
+
+def spectrum_features(pcm, fps=FPS, n_bars=N_BARS, sample_rate=SAMPLE_RATE):
+    # One Hann-windowed FFT centred on every video frame, reduced to bar levels
+    # in [0, 1] and a per-frame loudness. Returns (bars (frames, n_bars), energy (frames,)).
+    x = pcm.astype(np.float32) / 32768 if pcm.dtype == np.int16 else pcm.astype(np.float32)
+    n_frames = int(len(x) * fps / sample_rate)
+    padded = np.pad(x, (N_FFT // 2, N_FFT // 2))
+    windows = sliding_window_view(padded, N_FFT)
+    starts = np.round(np.arange(n_frames) * sample_rate / fps).astype(np.intp)
+    hann = np.hanning(N_FFT).astype(np.float32)
+    bands = band_matrix(n_bars, N_FFT, sample_rate)
+    tilt = (TILT_DB_PER_OCTAVE * np.log2(np.geomspace(F_MIN, F_MAX, n_bars) / F_MIN)).astype(np.float32)
+
+    levels = np.empty((n_frames, n_bars), dtype=np.float32)
+    energy = np.empty(n_frames, dtype=np.float32)
+    for i in range(0, n_frames, BATCH):
+        frames = windows[starts[i:i + BATCH]] * hann
+        spectrum = np.abs(np.fft.rfft(frames, axis=1)).astype(np.float32) @ bands
+        levels[i:i + BATCH] = 20 * np.log10(spectrum + 1e-9) + tilt
+        energy[i:i + BATCH] = np.sqrt(np.mean(frames ** 2, axis=1))
+
+    # dB relative to the loudest band anywhere in the track, FLOOR_DB -> 0, peak -> 1
+    levels -= levels.max()
+    levels = np.clip(levels / -FLOOR_DB + 1, 0, 1, out=levels)
+
+    # Instant attack, exponential release, as one filter pass over all frames
+    from scipy import signal
+    decay = np.exp(-1 / (fps * RELEASE_SEC))
+    released = signal.lfilter([1 - decay], [1, -decay], levels, axis=0).astype(np.float32)
+    levels = np.maximum(levels, released)
+    energy /= max(float(energy.max()), 1e-9)
+    return levels, energy
+
+class Visualizer:
+    # Composites bar frames over one background, in yuv420p. The pulse picks one
+    # of GLOW_LEVELS pre-brightened backgrounds, so a frame costs a copy and a
+    # masked select over the bar strip in each plane.
+
+    def __init__(self, background, colors=STYLE_COLORS["Lo-Fi Beats"], n_bars=N_BARS, strip=0.32, gap=0.25):
+        height, width, _ = background.shape
+        self.height, self.width = height, width
+        gains = 1 + GLOW_GAIN * np.linspace(0, 1, GLOW_LEVELS, dtype=np.float32)
+        self.backgrounds = np.stack([
+            rgb_to_yuv420(np.clip(background.astype(np.float32) * gain, 0, 255)) for gain in gains
+        ])
+
+        # Strip position and size are even so it lines up with the chroma planes
+        self.strip = int(height * strip) // 2 * 2
+        self.top = (height - self.strip - int(height * 0.04)) // 2 * 2
+        x = np.arange(width)
+        margin = width // 16
+        span = width - 2 * margin
+        self.bar_of_x = np.clip((x - margin) * n_bars // span, 0, n_bars - 1)
+        in_span = (x >= margin) & (x < margin + span)
+        in_bar = ((x - margin) * n_bars % span) >= gap * span
+        self.columns = in_span & in_bar
+
+        # Vertical colour ramp for the bars, one flat yuv420p image of the strip
+        t = np.linspace(1, 0, self.strip, dtype=np.float32)[:, None]
+        ramp = _rgb(colors[0]) * (1 - t) + _rgb(colors[1]) * t
+        bars = rgb_to_yuv420(np.broadcast_to(ramp[:, None, :], (self.strip, width, 3)))
+        self.bar_planes = self._planes(bars, self.strip, 0)
+        self.rows = np.arange(self.strip, dtype=np.float32)[:, None]
+
+    def _planes(self, flat, height, top):
+        # (Y, U, V) views of the rows [top, top + height) of a flat yuv420p image
+        # that is self.width wide and `flat` sized for its own full height
+        w, cw = self.width, self.width // 2
+        full = len(flat) * 2 // (3 * w)
+        y = flat[:full * w].reshape(full, w)
+        u = flat[full * w:full * w * 5 // 4].reshape(full // 2, cw)
+        v = flat[full * w * 5 // 4:].reshape(full // 2, cw)
+        return y[top:top + height], u[top // 2:(top + height) // 2], v[top // 2:(top + height) // 2]
+
+    def frames(self, levels, energy):
+        # Yield flat yuv420p uint8 frames; each one is reused once the next is
+        # requested
+        glow = np.minimum((energy * GLOW_LEVELS).astype(np.intp), GLOW_LEVELS - 1)
+        frame = np.empty(self.backgrounds.shape[1], dtype=np.uint8)
+        planes = self._planes(frame, self.strip, self.top)
+        for i in range(0, len(levels), BATCH):
+            # Bar top per column for the whole batch
+            heights = self.strip * (1 - levels[i:i + BATCH][:, self.bar_of_x])
+            heights[:, ~self.columns] = self.strip
+            for k, tops in enumerate(heights):
+                np.copyto(frame, self.backgrounds[glow[i + k]])
+                mask = self.rows >= tops
+                chroma_mask = mask[1::2, 1::2]
+                for plane, bars, where in zip(planes, self.bar_planes, (mask, chroma_mask, chroma_mask)):
+                    np.copyto(plane, bars, where=where)
+                yield frame
+
+def load_background(image_path, width=WIDTH, height=HEIGHT):
+    # x264's yuv420p needs even dimensions
+    with Image.open(image_path) as image:
+        return np.asarray(image.convert("RGB").resize((width // 2 * 2, height // 2 * 2), Image.BILINEAR))
+
+def render_visualizer(audio_path, image_path, mp4_path, style="Lo-Fi Beats", fps=FPS, width=WIDTH, height=HEIGHT,
+                      preset="ultrafast"):
+    # Visualizer MP4 for an encoded track: features from its decoded PCM, frames
+    # piped to ffmpeg as raw yuv420p, audio_path's audio transcoded to AAC
+    levels, energy = spectrum_features(decode_pcm(audio_path), fps)
+    visualizer = Visualizer(load_background(image_path, width, height), STYLE_COLORS.get(style, STYLE_COLORS["Lo-Fi Beats"]))
+    run_ffmpeg([
+        "-f", "rawvideo", "-pix_fmt", "yuv420p", "-s", f"{visualizer.width}x{visualizer.height}", "-r", str(fps),
+        "-i", "pipe:0",
+        "-i", audio_path,
+        "-map", "0:v", "-map", "1:a",
+        # Flat colour fields and hard bar edges: x264's animation tuning codes
+        # them faster and smaller. Compositing runs at ~1000 fps, so the encode
+        # sets the pace; let x264 thread over every core.
+        "-c:v", "libx264", "-preset", preset, "-tune", "animation", "-threads", "0",
+        *AAC_ARGS, "-shortest", "-movflags", "+faststart", mp4_path,
+    ], visualizer.frames(levels, energy))
+    return mp4_path
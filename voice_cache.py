@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+
+class VoiceCache:
+    # Bounded LRU of rendered, enveloped voices. Keys are plain tuples describing
+    # the voice (waveform, frequency, length, gain, envelope, echo, noise variant).
+    # Safe to share between threads, e.g. previews rendered in the UI process.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._voices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            wave = self._voices.get(key)
+            if wave is None:
+                self.misses += 1
+                return None
+            self._voices.move_to_end(key)
+            self.hits += 1
+            return wave
+
+    def put(self, key, wave):
+        # Voices too big to share the budget with others are not worth keeping
+        if wave.nbytes > self.max_bytes // 4:
+            return wave
+        with self._lock:
+            if key in self._voices:
+                return self._voices[key]
+            wave.setflags(write=False)
+            self._voices[key] = wave
+            self.nbytes += wave.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._voices.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+            return wave
+
+    def clear(self):
+        with self._lock:
+            self._voices.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._voices),
+                "bytes": self.nbytes,
+            }
+
+    def __len__(self):
+        return len(self._voices)